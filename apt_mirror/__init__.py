@@ -1,22 +1,52 @@
 # coding:utf-8
 
 from __future__ import print_function
+import argparse
+import copy
 import os
+import shutil
 import sys
 import subprocess
 import re
 import time
 import logging
 import threading
+import multiprocessing
 try:
     import queue
 except ImportError:
     import Queue as queue
 from .config import MirrorConfig
-from .utils import remove_double_slashes, remove_spaces, sanitise_uri, format_bytes, quoted_path, copy_file
-from .apt_index import MirrorSkel
+from .utils import remove_double_slashes, remove_spaces, sanitise_uri, format_bytes, quoted_path, copy_file, url_host, parse_size
+from .apt_index import MirrorSkel, RELEASE_FILES
+from .scheduler import TaskGraph
+from .index_cache import IndexCache
+from .filters import get_package_filter
+from .closure import DependencyClosure, read_seeds
+from .shard import ShardPlan
+from .cleanup import CleanupEngine, ManifestWriter, write_manifest, \
+    read_manifest
+from .progress import BatchWatcher, Progress, create_progress
+from .ratelimit import child_rates, create_limiter
+from .fetch import Fetcher, fetch_worker, hedge_monitor
+from .durable import DurableWriter, sync_filesystem
+from .verify import hash_file
+from .profiling import PhaseProfiler
+from .changes import ChangeManifest
+from .seed import Seeds, copy_local_files
+from .tracing import Tracer, trace_span
+from .keepset import KeepSet, sort_key
+from .iopriority import create_throttle, lower_priority
+from .versions import newest_versions
 
 COMPRESSIONS = ['.gz', '.bz2', '.xz']
+# progress stages of download_metadata
+METADATA_STAGES = ('index', 'translation', 'dep11', 'cnf')
+# stanza fields kept with each file for package filters, dependency
+# closures and keep_versions
+PACKAGE_FIELDS = ['Package', 'Section', 'Priority', 'Source',
+                  'Depends', 'Pre-Depends', 'Recommends', 'Provides',
+                  'Version', 'Architecture']
 
 
 def output(string):
@@ -24,17 +54,29 @@ def output(string):
     sys.stdout.flush()
 
 
-def download_worker(wget_args, rsync_args, logfile, task_queue):
+def download_worker(wget_args, rsync_args, logfile, task_queue,
+                    stage=None, progress=None, target_dir='.', tracer=None):
     while 1:
         try:
-            url = task_queue.get(block=False)
+            url, size = task_queue.get(block=False)
+            started = time.time()
             schema, filepath = url.split('://', 1)
             if schema == 'rsync':
+                filepath = os.path.join(target_dir, filepath)
                 subprocess.call(['mkdir', '-p', os.path.dirname(filepath)])
-                subprocess.call(
+                code = subprocess.call(
                     rsync_args + ['--log-file', logfile, url, filepath])
             else:
-                subprocess.call(wget_args + ['-o', logfile, url])
+                code = subprocess.call(wget_args + ['-o', logfile, url])
+            if tracer is not None:
+                tracer.complete(os.path.basename(filepath), 'transfer',
+                                started, args={'url': url,
+                                               'host': url_host(url),
+                                               'size': size,
+                                               'exit_code': code})
+            if progress is not None:
+                progress.add_bytes(stage, url_host(url), size)
+                progress.file_done(stage, url_host(url))
         except queue.Empty:
             break
     output("[" + str(threading.active_count() - 2) + "]... ")
@@ -54,17 +96,169 @@ def rsync_batch_downloader(args, listfile, logfile):
     return child
 
 
-def download_urls(stage, urls, context):
-    nthreads = min(context.nthreads, len(urls))
+def place_staged_files(staging_dir, target_dir, files):
+    """
+    move the immutable files wget saved under staging_dir over their stale
+    copies in target_dir, files is [(url, size, checksum)]; files which do
+    not match the index are dropped
+    """
+    for url, size, checksum in files:
+        staged = os.path.join(staging_dir, sanitise_uri(url))
+        if not os.path.isfile(staged):
+            continue
+        if size and os.path.getsize(staged) != size:
+            logging.warning('apt-mirror: %s: got %d of %d bytes'
+                            % (url, os.path.getsize(staged), size))
+            continue
+        if checksum and hash_file((staged, checksum[0]))[1] != checksum[1]:
+            logging.warning('apt-mirror: %s: %s mismatch' % (url, checksum[0]))
+            continue
+        path = os.path.join(target_dir, sanitise_uri(url))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        os.rename(staged, path)
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    try:
+        os.rmdir(os.path.dirname(staging_dir))
+    except OSError:
+        # staging trees of other stages
+        pass
+
+
+def wait_children(children, tracer=None):
+    # wait for our own children only, other stages may run concurrently
+    output("[" + str(len(children)) + "]... ")
+    while children:
+        time.sleep(0.2)
+        running = [c for c in children if c.poll() is None]
+        if len(running) != len(children):
+            if tracer is not None:
+                for child in children:
+                    if child not in running:
+                        tracer.complete(child.trace_name, 'batch',
+                                        child.trace_started,
+                                        args=dict(child.trace_args,
+                                                  exit_code=child.returncode),
+                                        track=child.trace_name)
+            children = running
+            output("[" + str(len(children)) + "]... ")
+
 
+def native_download(stage, urls, url_sizes, context, nthreads,
+                    progress_stage=None, progress=None, limiter=None,
+                    immutable=False, url_checksums=None, target_dir='.',
+                    tracer=None, throttle=None):
+    writer = None
+    if context.sync_interval > 0:
+        writer = DurableWriter(context.sync_interval, context.sync_batch,
+                               throttle)
+    fetcher = Fetcher(context, limiter=limiter, progress=progress,
+                      stage=progress_stage,
+                      logfile=os.path.join(context.var_path,
+                                           stage + '-log.native'),
+                      segments=context.segments,
+                      segment_threshold=parse_size(context.segment_threshold),
+                      writer=writer, tracer=tracer, throttle=throttle)
+    task_queue = queue.Queue()
+    url_checksums = url_checksums or {}
+    for url in urls:
+        task_queue.put((url, url_sizes[url], url_checksums.get(url)))
+    children = []
+    for i in range(nthreads):
+        task_queue.put(None)
+        child = threading.Thread(target=fetch_worker,
+                                 args=(fetcher, target_dir, task_queue,
+                                       immutable))
+        child.daemon = True
+        child.start()
+        children.append(child)
+    stopped = threading.Event()
+    hedge_ratio = float(context.hedge_ratio)
+    if hedge_ratio > 0:
+        # stalled connections at the end of the stage get a second request
+        alternates = dict(item.split('=', 1)
+                          for item in context.hedge_hosts.split())
+        monitor = threading.Thread(target=hedge_monitor,
+                                   args=(fetcher, task_queue, nthreads,
+                                         stopped, hedge_ratio,
+                                         context.hedge_after, alternates))
+        monitor.daemon = True
+        monitor.start()
+    print('Downloading in process')
+    print("Begin time: ", time.strftime('%c'))
+    fetcher.wait(len(urls), children)
+    stopped.set()
+    fetcher.close()
+    print("End time: ", time.strftime('%c'), "\n")
+
+
+def download_urls(stage, urls, context, nthreads=None, sizes=None,
+                  progress=None, limiter=None, immutable=False,
+                  checksums=None, target_dir=None, tracer=None,
+                  throttle=None):
+    # files go to target_dir/host/path, several stages may download into
+    # different directories at the same time
+    target_dir = target_dir or os.getcwd()
+    sizes = sizes or {}
+    checksums = checksums or {}
+    local_urls = [(base_url, rel_path) for base_url, rel_path in urls
+                  if base_url.startswith('file://')]
+    if local_urls:
+        urls = [(base_url, rel_path) for base_url, rel_path in urls
+                if not base_url.startswith('file://')]
+        output("Copying %d %s files from local sources...\n" %
+               (len(local_urls), stage))
+        copy_local_files(local_urls, target_dir, sizes, checksums,
+                         immutable, context.seed_link == 1)
+        if context.sync_stages:
+            sync_filesystem(target_dir)
+        if not urls:
+            return
+    max_threads = nthreads or context.nthreads
+    nthreads = min(max_threads, len(urls))
+    # metadata stages of all suites are reported as one stage
+    progress_stage = stage.split('-')[0]
+    watchers = []
+    traced = []
+    if progress is not None:
+        for base_url, rel_path in urls:
+            progress.plan(progress_stage, url_host(base_url),
+                          sizes.get((base_url, rel_path), 0))
+
+    def watch(files, child, name):
+        child.trace_name = '%s %s.%d' % (name, stage, len(traced))
+        child.trace_started = time.time()
+        child.trace_args = {'files': len(files),
+                            'bytes': sum(size for _path, size, _host in files),
+                            'hosts': sorted(set(host for _path, _size, host
+                                                in files))}
+        traced.append(child)
+        if progress is not None:
+            watcher = BatchWatcher(progress, progress_stage, files, child)
+            progress.watch(watcher)
+            watchers.append(watcher)
+
+    wget_dir = target_dir
+    if immutable:
+        # pool files never change once their size matches: no timestamp
+        # check, just one GET into a host/path tree of its own, moved over
+        # the stale copy once it is complete
+        wget_dir = os.path.join(target_dir, '.apt-mirror-partial', stage)
+        shutil.rmtree(wget_dir, ignore_errors=True)
+    # limit_rate is shared by the children of the stage
+    wget_rate, rsync_rate = child_rates(context.limit_rate, nthreads)
     wget_args = ['wget', '--no-cache',
-                 '--limit-rate=' + context.limit_rate,
-                 '-t', '5', '-r', '-N', '-l', 'inf']
+                 '--limit-rate=' + wget_rate,
+                 '-t', '5', '-P', wget_dir]
+    if immutable:
+        wget_args.append('-x')
+    else:
+        wget_args += ['-r', '-N', '-l', 'inf']
     rsync_args = ['rsync', '-t', '--no-motd',
                   '-K', '-L',
                   '--ignore-missing-args',
                   '--timeout=900',
-                  '--bwlimit', context.limit_rate]
+                  '--bwlimit', rsync_rate]
 
     if context.auth_no_challenge == 1:
         wget_args.append("--auth-no-challenge")
@@ -85,14 +279,15 @@ def download_urls(stage, urls, context):
             wget_args.append("-e proxy_user=" + context.proxy_user)
         if context.proxy_password:
             wget_args.append("-e proxy_password=" + context.proxy_password)
-    print("Downloading", len(urls),  stage,
-          "files using", nthreads, "threads...")
+    output("Downloading %d %s files using %d threads...\n" %
+           (len(urls), stage, nthreads))
 
     if context.use_queue and nthreads > 1:
         children = []
         download_queue = queue.Queue()
         for base_url, rel_path in urls:
-            download_queue.put(os.path.join(base_url, rel_path))
+            download_queue.put((os.path.join(base_url, rel_path),
+                                sizes.get((base_url, rel_path), 0)))
 
         with open(os.path.join(context.var_path,
                                stage + '-urls'),
@@ -106,7 +301,9 @@ def download_urls(stage, urls, context):
                                            rsync_args,
                                            '%s/%s-log.%d' % (context.var_path,
                                                              stage, i),
-                                           download_queue))
+                                           download_queue,
+                                           progress_stage, progress,
+                                           target_dir, tracer))
             child.start()
             children.append(child)
             i += 1
@@ -119,11 +316,22 @@ def download_urls(stage, urls, context):
             child.join()
 
         print("\nEnd time: ", time.strftime('%c'), "\n")
+        if immutable:
+            place_staged_files(wget_dir, target_dir, [
+                (os.path.join(base_url, rel_path),
+                 sizes.get((base_url, rel_path), 0),
+                 checksums.get((base_url, rel_path)))
+                for base_url, rel_path in urls
+                if not base_url.startswith('rsync://')])
+        if context.sync_stages:
+            sync_filesystem(target_dir)
 
     else:
         # split rsync and others
         rsync_urls = {}
         wget_urls = []
+        url_sizes = {}
+        url_checksums = {}
 
         for source, remote_path in urls:
             if source.startswith('rsync://'):
@@ -133,14 +341,27 @@ def download_urls(stage, urls, context):
                     rsync_urls[source] = [remote_path]
             else:
                 wget_urls.append(os.path.join(source, remote_path))
+                url_sizes[wget_urls[-1]] = sizes.get((source, remote_path), 0)
+                url_checksums[wget_urls[-1]] = checksums.get((source,
+                                                              remote_path))
+
+        if context.downloader == 'native' and wget_urls:
+            native_download(stage, wget_urls, url_sizes, context,
+                            min(max_threads, len(wget_urls)),
+                            progress_stage, progress, limiter,
+                            immutable, url_checksums, target_dir, tracer,
+                            throttle)
+            wget_urls = []
 
         # batch wget download
+        staged = [(url, url_sizes[url], url_checksums[url])
+                  for url in wget_urls]
         children = []
-        nthreads = min(context.nthreads, len(wget_urls))
+        nthreads = min(max_threads, len(wget_urls))
         i = 0
         while wget_urls:
             # splice
-            amount = len(wget_urls) / nthreads
+            amount = len(wget_urls) // nthreads
             part = wget_urls[:amount]
             wget_urls = wget_urls[amount:]
             with open(os.path.join(context.var_path,
@@ -152,6 +373,9 @@ def download_urls(stage, urls, context):
                                           context.var_path + "/" + stage + "-urls.%d" % i,
                                           context.var_path + "/" + stage + "-log.%d" % i
                                           )
+            watch([(os.path.join(wget_dir, sanitise_uri(url)),
+                    url_sizes[url], url_host(url)) for url in part], child,
+                  'wget')
             children.append(child)
             i += 1
             nthreads -= 1
@@ -159,22 +383,20 @@ def download_urls(stage, urls, context):
         if children:
             print('Downloading use wget')
             print("Begin time: ", time.strftime('%c'))
-            output("[" + str(len(children)) + "]... ")
-            while children:
-                pid, _retcode = os.wait()
-                children = [c for c in children if c.pid != pid]
-                output("[" + str(len(children)) + "]... ")
+            wait_children(children, tracer)
             print("\nEnd time: ", time.strftime('%c'), "\n")
+        if immutable and staged:
+            place_staged_files(wget_dir, target_dir, staged)
 
         # batch rsync download
         i = 0
         for source in rsync_urls:
             file_list = rsync_urls[source]
             children = []
-            nthreads = min(context.nthreads, len(file_list))
+            nthreads = min(max_threads, len(file_list))
             while file_list:
                 # splice
-                amount = len(file_list) / nthreads
+                amount = len(file_list) // nthreads
                 part = file_list[:amount]
                 file_list = file_list[amount:]
                 with open(os.path.join(context.var_path,
@@ -183,7 +405,7 @@ def download_urls(stage, urls, context):
                     FILES.write('#SOURCE: ' + source + '\n')
                     FILES.write('\n'.join(part) + '\n')
 
-                local_dir = sanitise_uri(source)
+                local_dir = os.path.join(target_dir, sanitise_uri(source))
                 if not os.path.exists(local_dir):
                     os.makedirs(local_dir)
 
@@ -191,62 +413,264 @@ def download_urls(stage, urls, context):
                                                context.var_path + "/" + stage + "-files.%d" % i,
                                                context.var_path + "/" + stage + "-log.rsync.%d" % i
                                                )
+                watch([(os.path.join(local_dir, rel_path),
+                        sizes.get((source, rel_path), 0), url_host(source))
+                       for rel_path in part], child, 'rsync')
                 children.append(child)
                 i += 1
                 nthreads -= 1
             if children:
                 print('Syncing from', source)
                 print("Begin time: ", time.strftime('%c'))
-                output("[" + str(len(children)) + "]... ")
-                while children:
-                    pid, _retcode = os.wait()
-                    children = [c for c in children if c.pid != pid]
-                    output("[" + str(len(children)) + "]... ")
+                wait_children(children, tracer)
                 print("\nEnd time: ", time.strftime('%c'), "\n")
 
+        if context.sync_stages:
+            # wget and rsync write in place
+            sync_filesystem(target_dir)
+
+    for watcher in watchers:
+        progress.unwatch(watcher)
+
+
+def index_cache_path(config):
+    if not config.index_cache and config.closure_seeds:
+        # the closure and process_index both read every Packages index,
+        # the second time from the column cache
+        return os.path.join(config.var_path, 'index-cache')
+    return config.index_cache
+
+
+def overlaps(path, other):
+    # one of the store paths contains the other
+    return path == other or path.startswith(other + '/') or \
+        other.startswith(path + '/')
+
+
+def run_local_worker(config_file, shard):
+    apt_mirror = AptMirror(config_file)
+    try:
+        # the coordinator reports the progress of the run
+        apt_mirror.run_worker(shard, report=False)
+    finally:
+        apt_mirror.close()
+
 
 class AptMirror(object):
-    def __init__(self, config_file):
-        self.lock_file = None
-        self.urls_to_download = {}
-        self.index_urls = []
-        self.stat_cache = {}
-        self.rm_dirs = []
-        self.rm_files = []
-        self.unnecessary_bytes = 0
+    def __init__(self, config_file, profile=False, trace=None):
+        self.config_file = config_file
+        self.profile = profile
+        self.profiler = None
+        self.tracer = Tracer(trace) if trace else None
+        self.lock_name = 'apt-mirror.lock'
+        self.changes = ChangeManifest()
         # config
         self.config = MirrorConfig(config_file)
+        # counters only, run() and run_worker() add the tty line and the
+        # event sink
+        self.progress = Progress()
+        self.limiter = create_limiter(self.config)
+        self.throttle = create_throttle(self.config)
         # global settings
         from . import utils
         utils.TILDE = self.config._tilde
+        if self.config.clean_method == 'merge':
+            # skipclean goes to sorted runs on disk, shared by the mirrors
+            keep = KeepSet(self.config.var_path)
+            for path in self.config.skipclean:
+                keep[path] = 1
+            self.config.skipclean = keep
+        self.reset_state()
 
         self.mirrors = []
         for base_url in self.config.mirrors:
             skel_path = os.path.join(
                 self.config.skel_path, sanitise_uri(base_url))
+            config = self.config
+            if self.config.lock_scope == 'mirror':
+                # lock, file lists and caches of each mirror in its own
+                # state directory
+                config = self.config.scoped(
+                    self.config.mirror_state_path(base_url))
             self.mirrors.append(MirrorSkel(remove_double_slashes(base_url),
                                            skel_path,
-                                           self.config.mirrors[base_url]))
+                                           self.config.mirrors[base_url],
+                                           config=config))
         return
 
+    def reset_state(self):
+        # the state of one run over self.mirrors
+        self.lock_file = None
+        self.urls_to_download = {}
+        self.url_checksums = {}
+        self.replaced_urls = set()
+        self.index_urls = []
+        self.stat_cache = {}
+        self.rm_dirs = []
+        self.rm_files = []
+        self.rm_sizes = []
+        self.rm_count = 0
+        self.rm_dir_count = 0
+        self.unnecessary_bytes = 0
+        self.closure = None
+        self.index_cache = None
+        index_cache = index_cache_path(self.config)
+        if index_cache:
+            self.index_cache = IndexCache(index_cache,
+                                          tilde=self.config._tilde)
+
+    def finish_stages(self, *stages):
+        # the mirror runs share the progress stages, run_mirrors() finishes
+        # them when all of the runs are done
+        if self.config.lock_scope != 'mirror':
+            for stage in stages:
+                self.progress.finish(stage)
+
+    def prune_index_caches(self, runs):
+        # an index_cache outside $var_path is shared by the mirror runs:
+        # prune it once with what all of them used, and not at all when
+        # one of its mirrors was skipped
+        ran = dict((run.mirrors[0].url, run) for run in runs)
+        caches = {}
+        for mirror in self.mirrors:
+            if index_cache_path(mirror.config):
+                caches.setdefault(index_cache_path(mirror.config),
+                                  []).append(mirror.url)
+        for urls in caches.values():
+            if not all(url in ran for url in urls):
+                continue
+            cache = ran[urls[0]].index_cache
+            for url in urls[1:]:
+                cache.used |= ran[url].index_cache.used
+            cache.prune()
+
+    def mirror_run(self, mirror):
+        """
+        an AptMirror for one upstream mirror, with its own state; config
+        variables like skipclean, progress, the bandwidth limiter and the
+        change manifest are shared with self
+        """
+        run = copy.copy(self)
+        run.config = mirror.config
+        run.mirrors = [mirror]
+        run.profiler = None
+        run.reset_state()
+        return run
+
     def run(self):
+        self.progress = create_progress(self.config)
         self.init()
+        if self.config.lock_scope == 'mirror':
+            self.run_mirrors()
+            return
         self.lock_aptmirror()
+        if self.profile:
+            self.profiler = PhaseProfiler(
+                os.path.join(self.config.var_path, 'profile'))
+        self.progress.start()
 
         # Skel download
-        self.download_skel()
-        self.download_translation()
-        self.download_dep11()
-        self.download_cnf()
+        self.phase('metadata', self.download_metadata)
 
         # Main download
-        self.download_archive()
-        self.copy_skel()
+        self.phase('archive', self.download_archive)
+        self.phase('copy_skel', self.copy_skel)
         # Make cleaning script
-        self.clean()
-        self.post()
+        self.phase('clean', self.clean)
+        self.progress.stop()
+        self.write_changes()
+        self.phase('post', self.post)
+
+        if self.profiler is not None:
+            print("Profiles are written to", self.profiler.profile_dir)
+        self.unlock_aptmirror()
+
+    def run_mirrors(self):
+        # each mirror is locked on its own: mirrors locked by another
+        # apt-mirror are skipped, the others are synced in parallel
+        runs = []
+        for mirror in self.mirrors:
+            run = self.mirror_run(mirror)
+            run.init()
+            if run.lock_aptmirror(wait=False):
+                runs.append(run)
+            else:
+                print(mirror.url, "is locked by another apt-mirror, skipped")
+        if self.profile:
+            self.profiler = PhaseProfiler(
+                os.path.join(self.config.var_path, 'profile'))
+        self.progress.start()
+
+        graph = TaskGraph()
+        for run in runs:
+            graph.add('mirror ' + run.mirrors[0].url, run.sync)
+        self.phase('mirrors',
+                   lambda: graph.run(self.config.mirror_jobs))
+        self.prune_index_caches(runs)
+        for stage in METADATA_STAGES + ('archive',):
+            self.progress.finish(stage)
+
+        # only directories that no other apt-mirror is working in
+        locked = [sanitise_uri(run.mirrors[0].url) for run in runs]
+        directories = []
+        for path in self.config.clean_directory:
+            owners = [sanitise_uri(mirror.url) for mirror in self.mirrors
+                      if overlaps(path, sanitise_uri(mirror.url))]
+            if all(owner in locked for owner in owners):
+                directories.append(path)
+        # one apt-mirror at a time writes clean.sh and runs postmirror;
+        # this lock file is never removed, a waiting apt-mirror could hold
+        # a lock on a deleted file otherwise
+        import fcntl
+        clean_lock = open(os.path.join(self.config.var_path, 'clean.lock'),
+                          'a')
+        fcntl.lockf(clean_lock, fcntl.LOCK_EX)
+        self.phase('clean', lambda: self.clean(directories))
+        self.progress.stop()
+        self.write_changes()
+        self.phase('post', self.post)
+        clean_lock.close()
+
+        for run in runs:
+            run.unlock_aptmirror()
+
+    def sync(self):
+        self.phase('metadata', self.download_metadata)
+        self.phase('archive', self.download_archive)
+        self.phase('copy_skel', self.copy_skel)
+
+    def phase(self, name, func):
+        with trace_span(self.tracer, name, 'phase'):
+            if self.profiler is None:
+                return func()
+            return self.profiler.run(name, func)
+
+    def verify(self):
+        # check the mirrored files, download the broken ones again
+        self.init()
+        self.lock_aptmirror()
 
+        broken = 0
+        runs = []
+        for mirror in self.mirrors:
+            if self.config.lock_scope == 'mirror':
+                run = self.mirror_run(mirror)
+                run.init()
+                if not run.lock_aptmirror(wait=False):
+                    print(mirror.url, "is locked by another apt-mirror, skipped")
+                    continue
+                runs.append(run)
+            print("Verifying", mirror.url)
+            failed = mirror.check_md5()
+            print(len(failed), "files are missing or broken.")
+            for filename in failed:
+                if not mirror.fix(filename, retry=self.config.verify_retries):
+                    broken += 1
+
+        for run in runs:
+            run.unlock_aptmirror()
         self.unlock_aptmirror()
+        return broken
 
     def init(self):
         # Create the 3 needed directories if they don't exist yet
@@ -257,19 +681,108 @@ class AptMirror(object):
             if not os.path.isdir(directory):
                 os.makedirs(directory)
 
-    def lock_aptmirror(self):
+    def lock_aptmirror(self, lock_dir=None, wait=True):
+        """
+        without wait, return False if another apt-mirror holds the lock
+        rather than exiting
+        """
         import fcntl
         self.lock_file = open(os.path.join(
-            self.config.var_path, 'apt-mirror.lock'), 'a')
+            lock_dir or self.config.var_path, self.lock_name), 'a')
         try:
             fcntl.lockf(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
         except:
+            if not wait:
+                self.lock_file.close()
+                self.lock_file = None
+                return False
             print("apt-mirror is already running, exiting")
             sys.exit(1)
+        return True
+
+    def close(self):
+        # the sorted runs of the keep set, also after a failed run
+        if isinstance(self.config.skipclean, KeepSet):
+            self.config.skipclean.close()
 
     def unlock_aptmirror(self):
         self.lock_file.close()
-        os.unlink(os.path.join(self.config.var_path, "apt-mirror.lock"))
+        os.unlink(self.lock_file.name)
+
+    def run_worker(self, shard, report=True):
+        # download one shard of the archive planned by the coordinator
+        if report:
+            self.progress = create_progress(self.config)
+        self.init()
+        plan = ShardPlan(self.config.shard_path, self.config.shards)
+        if not os.path.isdir(self.config.shard_path):
+            os.makedirs(self.config.shard_path)
+        self.lock_name = 'shard-%d.lock' % shard
+        self.lock_aptmirror(self.config.shard_path)
+
+        started = time.time()
+        while 1:
+            try:
+                run_id = plan.run_id()
+            except IOError:
+                run_id = None
+            if run_id and plan.result(shard, run_id) is None:
+                try:
+                    self.urls_to_download = plan.read(shard, run_id)
+                    break
+                except IOError:
+                    # replaced by the list of a newer run meanwhile
+                    pass
+            if self.config.shard_timeout and \
+                    time.time() - started > self.config.shard_timeout:
+                print("No plan for shard", shard, "from the coordinator")
+                sys.exit(1)
+            time.sleep(2)
+
+        self.progress.start()
+        print(format_bytes(sum(self.urls_to_download.values())),
+              " will be downloaded into archive by shard", shard)
+        self.do_download('archive-shard%d' % shard)
+
+        failed = []
+        for (base_url, rel_path), size in self.urls_to_download.items():
+            path = os.path.join(self.config.mirror_path,
+                                sanitise_uri(base_url), rel_path)
+            if self._stat(path) != size:
+                failed.append(os.path.join(base_url, rel_path))
+        plan.report(shard, run_id, failed)
+        self.progress.stop()
+
+        self.unlock_aptmirror()
+
+    def distribute_archive(self, urls=None):
+        # the coordinator splits the download set, workers on other nodes
+        # (or local processes) download it
+        if urls is None:
+            urls = self.urls_to_download
+        plan = ShardPlan(self.config.shard_path, self.config.shards)
+        run_id = plan.write(urls)
+        print("Download set is split into", self.config.shards, "shards in",
+              self.config.shard_path)
+
+        workers = []
+        if self.config.shard_local_workers:
+            for shard in range(self.config.shards):
+                worker = multiprocessing.Process(target=run_local_worker,
+                                                 args=(self.config_file, shard))
+                worker.shard = shard
+                worker.start()
+                workers.append(worker)
+
+        failed = plan.wait(run_id, timeout=self.config.shard_timeout,
+                           workers=workers)
+        for worker in workers:
+            worker.join()
+        for url in failed:
+            logging.warning('apt-mirror: shard worker failed to download %s'
+                            % url)
+        print("All", self.config.shards, "shards are done,",
+              len(failed), "files failed.\n")
 
     def _stat(self, filename):
         if filename in self.stat_cache:
@@ -294,25 +807,40 @@ class AptMirror(object):
         else:
             return 1
 
-    def do_download(self, stage):
-        urls = sorted(self.urls_to_download.keys())
-        if stage == 'archive':
-            os.chdir(self.config.mirror_path)
+    def do_download(self, stage, urls=None, nthreads=None):
+        if urls is None:
+            urls = self.urls_to_download
+        sizes = urls
+        urls = sorted(urls.keys())
+        immutable = stage.startswith('archive')
+        if immutable:
+            target_dir = self.config.mirror_path
         else:
-            os.chdir(self.config.skel_path)
-            # index urls
+            # index urls go to skel first
+            target_dir = self.config.skel_path
             self.index_urls.extend([os.path.join(base_url, rel_path)
                                     for base_url, rel_path in urls])
+        if not urls:
+            return
 
-        return download_urls(stage, urls, context=self.config)
-
-    def add_url_to_download(self, base_url, rel_path, size=0):
+        with trace_span(self.tracer, stage, 'stage',
+                        {'files': len(urls),
+                         'bytes': sum(sizes[url] for url in urls)}):
+            return download_urls(stage, urls, context=self.config,
+                                 nthreads=nthreads, sizes=sizes,
+                                 progress=self.progress,
+                                 limiter=self.limiter,
+                                 immutable=immutable,
+                                 checksums=self.url_checksums,
+                                 target_dir=target_dir, tracer=self.tracer,
+                                 throttle=self.throttle)
+
+    def add_url_to_download(self, base_url, rel_path, size=0, checksum=None):
         self.urls_to_download[(base_url, rel_path)] = size
+        if checksum:
+            self.url_checksums[(base_url, rel_path)] = checksum
 
-    def process_index(self, uri, index_path):
-        base_path = sanitise_uri(uri)
-        mirror = self.config.mirror_path + "/" + base_path
-
+    def decompress_index(self, index_path):
         if os.path.exists(index_path + '.gz'):
             os.system("gunzip < %s.gz > %s" % (index_path, index_path))
         elif os.path.exists(index_path + ".xz"):
@@ -320,14 +848,19 @@ class AptMirror(object):
         elif os.path.exists(index_path + ".bz2"):
             os.system("bzip2 -d < %s.bz2 > %s" % (index_path, index_path))
 
+    def parse_index(self, index_path):
+        """Return the files listed in a Packages or Sources index, a dict
+        with Filename, Size and checksums for each file.
+        """
         try:
             index_file = open(index_path)
         except:
             logging.warn(
                 "apt-mirror: can't open index %s in process_index" % index_path)
-            return
+            return None
 
         pkg_field_pattern = re.compile(r'^([\w\-]+):(.*)')
+        entries = []
 
         for package in index_file.read().split('\n\n'):
             package = package.strip()
@@ -351,25 +884,20 @@ class AptMirror(object):
 
             remove_spaces(data)
 
+            fields = {}
+            for key in PACKAGE_FIELDS:
+                if key in data:
+                    fields[key] = data[key].strip()
+
             if 'Filename' in data:
                 # Packages index
-                rel_path = remove_double_slashes(data['Filename'])
-                store_path = os.path.join(base_path, rel_path)
-                self.config.skipclean[store_path] = 1
-                self.list_files['all'].write(store_path + '\n')
-
+                entry = {'Filename': remove_double_slashes(data['Filename']),
+                         'Size': int(data['Size'])}
                 for key in ['MD5sum', 'SHA1', 'SHA256']:
                     if key in data:
-                        self.list_files[key].write(
-                            data[key] + '  ' + store_path + '\n')
-                if self.need_update(os.path.join(mirror, rel_path), int(data["Size"])):
-                    download_uri = os.path.join(uri, rel_path)
-                    self.list_files['new'].write(download_uri + "\n")
-                    self.add_url_to_download(
-                        uri,
-                        rel_path,
-                        int(data['Size'])
-                    )
+                        entry[key] = data[key]
+                entry.update(fields)
+                entries.append(entry)
             else:
                 # Sources index
                 for line in data['Files'].split('\n'):
@@ -380,94 +908,234 @@ class AptMirror(object):
                         md5sum, size, fn = line.split()
                     except:
                         raise Exception('apt-mirror: invalid Sources format')
-                    rel_path = remove_double_slashes(
-                        data["Directory"] + "/" + fn)
-                    store_path = os.path.join(base_path, rel_path)
-                    self.config.skipclean[store_path] = 1
-                    self.list_files['all'].write(store_path + "\n")
-                    self.list_files['MD5sum'].write(
-                        md5sum + "  " + store_path + "\n")
-                    if self.need_update(os.path.join(mirror, rel_path), int(size)):
-                        download_uri = os.path.join(uri, rel_path)
-                        self.list_files['new'].write(download_uri + "\n")
-                        self.add_url_to_download(
-                            uri,
-                            rel_path, int(size))
+                    entry = {'Filename': remove_double_slashes(
+                                 data["Directory"] + "/" + fn),
+                             'Size': int(size),
+                             'MD5sum': md5sum}
+                    entry.update(fields)
+                    entries.append(entry)
 
         index_file.close()
+        return entries
+
+    def load_index(self, index_path, suite=None):
+        digest = None
+        if suite is not None and self.index_cache is not None:
+            _local_file, digest = suite.index_checksum(index_path)
+        if digest:
+            parsed = self.index_cache.load(digest)
+            if parsed is not None:
+                # copy_skel still needs the uncompressed index
+                if not os.path.exists(index_path) or \
+                        os.path.getsize(index_path) != parsed.header['raw_size']:
+                    self.decompress_index(index_path)
+                return parsed.entries()
+
+        self.decompress_index(index_path)
+        entries = self.parse_index(index_path)
+        if entries is not None and digest:
+            self.index_cache.save(digest, entries,
+                                  raw_size=os.path.getsize(index_path))
+        return entries
+
+    def process_index(self, uri, index_path, suite=None):
+        base_path = sanitise_uri(uri)
+        mirror = self.config.mirror_path + "/" + base_path
 
-    def download_skel(self):
-        self.urls_to_download = {}
+        entries = self.load_index(index_path, suite)
+        if entries is None:
+            return
 
+        package_filter = None
+        if suite is not None:
+            package_filter = get_package_filter(self.config, suite)
+
+        # filtered out files are never downloaded, and cleaned if they
+        # were mirrored before
+        if package_filter:
+            entries = (entry for entry in entries
+                       if package_filter.match(entry))
+        if self.closure:
+            entries = (entry for entry in entries
+                       if self.closure.match(index_path, entry))
+        if self.config.keep_versions > 0:
+            entries = newest_versions(
+                entries, self.config.keep_versions,
+                source=os.path.basename(index_path).startswith('Sources'))
+
+        for entry in entries:
+            rel_path = entry['Filename']
+            store_path = os.path.join(base_path, rel_path)
+            self.config.skipclean[store_path] = 1
+            self.list_files['all'].write(store_path + '\n')
+
+            for key in ['MD5sum', 'SHA1', 'SHA256']:
+                if key in entry:
+                    self.list_files[key].write(
+                        entry[key] + '  ' + store_path + '\n')
+            if self.need_update(os.path.join(mirror, rel_path), entry['Size']):
+                download_uri = os.path.join(uri, rel_path)
+                self.list_files['new'].write(download_uri + "\n")
+                checksum = None
+                if 'SHA256' in entry:
+                    checksum = ('sha256', entry['SHA256'])
+                elif 'MD5sum' in entry:
+                    checksum = ('md5', entry['MD5sum'])
+                self.add_url_to_download(uri, rel_path, entry['Size'],
+                                         checksum)
+                if self._stat(os.path.join(mirror, rel_path)):
+                    # a stale copy, for the change manifest
+                    self.replaced_urls.add((uri, rel_path))
+
+    def download_metadata(self):
+        # one small task graph per suite: translation, DEP-11 and cnf files
+        # only depend on the Release/i18n Index files of their own suite
+        graph = TaskGraph()
         for mirror in self.mirrors:
-            for rel_path in mirror.get_indexes(contents=self.config._contents):
-                self.add_url_to_download(
-                    mirror.url, remove_double_slashes(rel_path))
-
-        self.do_download('index')
-
-        for base_url, rel_path in self.urls_to_download.keys():
-            path = os.path.join(base_url.split('://')[-1], rel_path)
+            for suite in mirror.suites:
+                skel = graph.add('index ' + suite.url,
+                                 self.download_skel, suite)
+                for stage in (self.download_translation,
+                              self.download_dep11,
+                              self.download_cnf):
+                    graph.add(stage.__name__ + ' ' + suite.url,
+                              stage, suite, deps=[skel])
+
+        graph.run(self.config.metadata_jobs)
+        self.finish_stages(*METADATA_STAGES)
+
+    def suite_stage(self, stage, suite):
+        # unique stage name for the url/log files of a suite task
+        return stage + '-' + sanitise_uri(suite.url).replace('/', '_')
+
+    def suite_threads(self):
+        return max(1, self.config.nthreads // max(1, self.config.metadata_jobs))
+
+    def download_skel(self, suite):
+        base_url = suite.mirror.url
+        stage = self.suite_stage('index', suite)
+        indexes = [remove_double_slashes(rel_path) for rel_path in
+                   suite.get_indexes(contents=self.config._contents)]
+
+        # Release first, it tells whether the other indexes can be fetched
+        # by hash and which hashes belong together
+        release_files = [rel_path for rel_path in indexes
+                         if os.path.basename(rel_path) in RELEASE_FILES]
+        self.do_download(stage, dict(((base_url, rel_path), 0)
+                                     for rel_path in release_files),
+                         nthreads=self.suite_threads())
+        indexes = dict((rel_path, 0) for rel_path in indexes
+                       if rel_path not in release_files)
+        published = release_files + self.download_by_hash(stage, suite,
+                                                          indexes)
+
+        self.do_download(stage, dict(((base_url, rel_path), 0)
+                                     for rel_path in indexes),
+                         nthreads=self.suite_threads())
+        published += list(indexes.keys())
+
+        for rel_path in published:
+            path = os.path.join(base_url.split('://')[-1].lstrip('/'),
+                                rel_path)
             self.config.skipclean[path] = 1
             if path.endswith('.gz') or path.endswith('.bz2'):
                 self.config.skipclean[path.rsplit('.', 1)[0]] = 1
 
-    def download_translation(self):
-        # Translation index download
-        self.urls_to_download = {}
-        output("Processing translation indexes: [")
-        for mirror in self.mirrors:
-            for suite in mirror.suites:
-                output('T')
-                for rel_path, size in suite.find_translation_files_in_index().items():
-                    self.add_url_to_download(
-                        mirror.url, remove_double_slashes(rel_path), size)
-
-        output("]\n\n")
-
-        self.do_download('translation')
-
-        for base_url, rel_path in self.urls_to_download.keys():
-            path = os.path.join(base_url.split('://')[-1], rel_path)
+    def download_by_hash(self, stage, suite, files):
+        """
+        fetch the files listed in Release from by-hash/SHA256/<digest> if
+        the Release says so: whatever the upstream publishes meanwhile, they
+        match the Release we have. They are copied to their names in skel,
+        removed from files and both paths are returned.
+        """
+        if not suite.acquire_by_hash():
+            return []
+        base_url = suite.mirror.url
+        hashed = {}
+        urls = {}
+        for rel_path in files:
+            found = suite.by_hash_path(rel_path)
+            if found is None:
+                continue
+            hashed[rel_path] = found
+            urls[(base_url, found[0])] = found[2]
+            self.url_checksums[(base_url, found[0])] = ('sha256', found[1])
+        self.do_download(stage + '-by-hash', urls,
+                         nthreads=self.suite_threads())
+
+        published = []
+        for rel_path, (hash_path, digest, size) in hashed.items():
+            hash_file_path = os.path.join(
+                self.config.skel_path,
+                sanitise_uri(os.path.join(base_url, hash_path)))
+            if hash_file((hash_file_path, 'sha256'))[1] != digest:
+                # not published by hash after all, fetch it by name
+                continue
+            # the rest of apt-mirror reads the indexes by name
+            copy_file(hash_file_path, os.path.join(
+                self.config.skel_path,
+                sanitise_uri(os.path.join(base_url, rel_path))))
+            self.index_urls.append(os.path.join(base_url, rel_path))
+            published += [hash_path, rel_path]
+            del files[rel_path]
+        # clients may hold the Release published by the last run until
+        # they update: its by-hash files stay for one more generation
+        published += suite.previous_by_hash_paths(self.config.mirror_path)
+        return published
+
+    def download_suite_files(self, stage, suite, files):
+        files = dict((remove_double_slashes(rel_path), size)
+                     for rel_path, size in files.items())
+        published = self.download_by_hash(self.suite_stage(stage, suite),
+                                          suite, files)
+        urls = {}
+        for rel_path, size in files.items():
+            urls[(suite.mirror.url, rel_path)] = size
+
+        self.do_download(self.suite_stage(stage, suite), urls,
+                         nthreads=self.suite_threads())
+
+        for rel_path in published + list(files.keys()):
+            path = os.path.join(
+                suite.mirror.url.split('://')[-1].lstrip('/'), rel_path)
             self.config.skipclean[path] = 1
 
-    def download_dep11(self):
+    def download_translation(self, suite):
+        # Translation index download
+        # translations of unwanted languages are neither downloaded nor
+        # kept by skipclean, so existing copies are cleaned away
+        languages = self.config.languages.replace(',', ' ').split()
+        self.download_suite_files('translation', suite,
+                                  suite.find_translation_files_in_index(
+                                      languages=languages))
+
+    def download_dep11(self, suite):
         # DEP-11 index download
-        self.urls_to_download = {}
-        output("Processing DEP-11 indexes: [")
+        self.download_suite_files('dep11', suite,
+                                  suite.find_dep11_files_in_release())
+
+    def download_cnf(self, suite):
+        # Commands index download
+        self.download_suite_files('cnf', suite,
+                                  suite.find_cnf_files_in_release())
+
+    def dependency_closure(self):
+        # first pass over the Packages indexes, only the packages reachable
+        # from the seeds are kept in the second pass
+        self.closure = DependencyClosure(
+            read_seeds(self.config.closure_seeds),
+            recommends=self.config.closure_recommends)
+        output("Resolving dependencies: [")
         for mirror in self.mirrors:
             for suite in mirror.suites:
-                output('D')
-                for rel_path, size in suite.find_dep11_files_in_release().items():
-                    self.add_url_to_download(
-                        mirror.url, remove_double_slashes(rel_path), size)
-
-        output("]\n\n")
-
-        self.do_download('dep11')
-
-        for base_url, rel_path in self.urls_to_download.keys():
-            path = os.path.join(base_url.split('://')[-1], rel_path)
-            self.config.skipclean[path] = 1
-    
-    def download_cnf(self):
-            # DEP-11 index download
-        self.urls_to_download = {}
-        output("Processing Commands indexes: [")
-        for mirror in self.mirrors:
-            for suite in mirror.suites:
-                output('D')
-                for rel_path, size in suite.find_cnf_files_in_release().items():
-                    self.add_url_to_download(
-                        mirror.url, remove_double_slashes(rel_path), size)
-
+                for package_index in suite.packages:
+                    output('P')
+                    entries = self.load_index(package_index, suite)
+                    if entries is not None:
+                        self.closure.add_index(package_index, entries)
+        found = self.closure.compute()
         output("]\n\n")
-
-        self.do_download('cnf')
-
-        for base_url, rel_path in self.urls_to_download.keys():
-            path = os.path.join(base_url.split('://')[-1], rel_path)
-            self.config.skipclean[path] = 1
+        print(len(found), "packages are needed by the seed packages.")
 
     def download_archive(self):
         self.urls_to_download = {}
@@ -483,47 +1151,126 @@ class AptMirror(object):
                 'wb'
             )
 
+        self.closure = None
+        if self.config.closure_seeds:
+            self.dependency_closure()
+
         output("Processing indexes: [")
         for mirror in self.mirrors:
             for suite in mirror.suites:
                 for source_index in suite.sources:
                     output('S')
-                    self.process_index(mirror.url, source_index)
+                    with trace_span(self.tracer, source_index, 'index'):
+                        self.process_index(mirror.url, source_index, suite)
                 for package_index in suite.packages:
                     output('P')
-                    self.process_index(mirror.url, package_index)
+                    with trace_span(self.tracer, package_index, 'index'):
+                        self.process_index(mirror.url, package_index, suite)
 
         self.clear_stat_cache()
+        if self.index_cache is not None and \
+                self.config.lock_scope != 'mirror':
+            # mirror runs may share the cache, see prune_index_caches()
+            self.index_cache.prune()
 
         output("]\n\n")
 
         for fp in self.list_files.values():
             fp.close()
 
-        need_bytes = sum(self.urls_to_download.itervalues())
+        urls = self.urls_to_download
+        if self.config.seed_paths:
+            urls = self.seed_archive()
+
+        need_bytes = sum(urls.values())
 
         size_output = format_bytes(need_bytes)
 
         print(size_output, " will be downloaded into archive.")
-        self.do_download('archive')
+        if self.config.shards > 0:
+            self.distribute_archive(urls)
+        else:
+            self.do_download('archive', urls)
+        self.finish_stages('archive')
+        self.record_archive_changes()
+
+    def seed_archive(self):
+        # pool files found in the seed directories are not downloaded;
+        # they stay in urls_to_download and are recorded as changes
+        seeds = Seeds(self.config.seed_paths.split(),
+                      link=self.config.seed_link == 1,
+                      jobs=min(self.config.nthreads,
+                               multiprocessing.cpu_count()))
+        output("Looking for %d files in seed directories...\n"
+               % len(self.urls_to_download))
+        seeded = seeds.seed(self.urls_to_download, self.url_checksums,
+                            self.config.mirror_path)
+        methods = {}
+        for method in seeded.values():
+            methods[method] = methods.get(method, 0) + 1
+        print(len(seeded), "files",
+              "(%s)" % format_bytes(sum(self.urls_to_download[key]
+                                        for key in seeded)),
+              "seeded:", ', '.join('%d by %s' % (methods[method], method)
+                                   for method in sorted(methods)) or 'none')
+        if seeded and self.config.sync_stages:
+            sync_filesystem(self.config.mirror_path)
+        return dict((key, size)
+                    for key, size in self.urls_to_download.items()
+                    if key not in seeded)
+
+    def record_archive_changes(self):
+        # the files that arrived complete
+        for (base_url, rel_path), size in self.urls_to_download.items():
+            store_path = os.path.join(sanitise_uri(base_url), rel_path)
+            path = self.config.mirror_path + "/" + store_path
+            try:
+                if os.stat(path).st_size != size:
+                    continue
+            except OSError:
+                continue
+            self.changes.added(store_path, size,
+                               self.url_checksums.get((base_url, rel_path)),
+                               existed=(base_url, rel_path) in self.replaced_urls)
 
     def copy_skel(self):
-        # Copy skel to main archive
-        for url in self.index_urls:
+        # Copy skel to main archive, Release files last so that clients
+        # never see a Release whose indexes are not in place yet
+        for url in sorted(self.index_urls, key=lambda url:
+                          os.path.basename(url) in RELEASE_FILES):
             if not re.match(r'^(\w+)://', url):
                 raise Exception(
                     'apt-mirror: invalid url "%s" in index_urls' % url)
-            rel_store_path = sanitise_uri(url)
-            copy_file(self.config.skel_path + "/" + rel_store_path,
-                      self.config.mirror_path + "/" + rel_store_path,
-                      unlink=self.config.unlink)
+            self.publish_skel_file(sanitise_uri(url))
             for ext in COMPRESSIONS:
                 if url.endswith(ext):
                     raw_file = url.rsplit('.', 1)[0]
-                    rel_store_path = sanitise_uri(raw_file)
-                    copy_file(self.config.skel_path + "/" + rel_store_path,
-                              self.config.mirror_path + "/" + rel_store_path,
-                              unlink=self.config.unlink)
+                    self.publish_skel_file(sanitise_uri(raw_file))
+
+    def publish_skel_file(self, rel_store_path):
+        source = self.config.skel_path + "/" + rel_store_path
+        target = self.config.mirror_path + "/" + rel_store_path
+        if not os.path.exists(source):
+            return
+        source_stat = os.stat(source)
+        try:
+            target_stat = os.stat(target)
+        except OSError:
+            target_stat = None
+        old_digest = None
+        if target_stat is not None and \
+                target_stat.st_size == source_stat.st_size:
+            if int(target_stat.st_mtime) == int(source_stat.st_mtime):
+                # copy_file keeps the mtime, this index did not change
+                copy_file(source, target, unlink=self.config.unlink)
+                return
+            old_digest = hash_file((target, 'sha256'))[1]
+        copy_file(source, target, unlink=self.config.unlink)
+        digest = hash_file((target, 'sha256'))[1]
+        if digest != old_digest:
+            self.changes.added(rel_store_path, source_stat.st_size,
+                               ('sha256', digest),
+                               existed=target_stat is not None)
 
     def process_file(self, path):
         if self.config._tilde:
@@ -532,9 +1279,9 @@ class AptMirror(object):
             return 1
         self.rm_files.append(sanitise_uri(path))
 
-        block_count, block_size = os.popen(
-            'stat -c "%b,%B" ' + path).read().strip().split(',')
-        self.unnecessary_bytes += int(block_count) * int(block_size)
+        st = os.lstat(path)
+        self.rm_sizes.append(st.st_size)
+        self.unnecessary_bytes += st.st_blocks * 512
         return 0
 
     def process_directory(self, directory):
@@ -555,68 +1302,129 @@ class AptMirror(object):
             self.rm_dirs.append(directory)
         return is_needed
 
-    def clean(self):
-        os.chdir(self.config.mirror_path)
+    def merge_directory(self, directory, key, keep, manifest):
+        """
+        clean_method merge: process_directory with the entries of every
+        directory visited in keep set order, obsolete paths are written to
+        the manifest at once
+        """
+        if keep.seek(key):
+            return 1
+        is_needed = 0
+        entries = [(name.replace('~', '%7E') if self.config._tilde else name,
+                    name) for name in os.listdir(directory)]
+        for lookup_name, name in sorted(entries):
+            path = directory + "/" + name
+            sub_key = key + '\0' + lookup_name
+            if os.path.islink(path):
+                # symlinks are always needed
+                is_needed |= 1
+            elif os.path.isdir(path):
+                is_needed |= self.merge_directory(path, sub_key, keep,
+                                                  manifest)
+            elif os.path.isfile(path):
+                if keep.seek(sub_key):
+                    is_needed |= 1
+                    continue
+                st = os.lstat(path)
+                manifest.write('f', sanitise_uri(path))
+                self.rm_count += 1
+                self.unnecessary_bytes += st.st_blocks * 512
+                if self.config._autoclean:
+                    # taken back below if it is still there
+                    self.changes.removed(sanitise_uri(path), st.st_size)
 
-        for path in self.config.clean_directory:
-            if os.path.isdir(path) and not os.path.islink(path):
-                self.process_directory(path)
+        if not is_needed:
+            manifest.write('d', directory)
+            self.rm_dir_count += 1
+        return is_needed
 
-        script = open(self.config.cleanscript, 'w')
+    def merge_clean(self, directories):
+        # one merge join per clean directory, each from the start of the
+        # keep set
+        manifest = ManifestWriter(self.config.clean_manifest,
+                                  self.config.mirror_path)
+        for path in directories:
+            if os.path.isdir(path) and not os.path.islink(path):
+                key = sort_key(path.replace('~', '%7E')
+                               if self.config._tilde else path)
+                self.merge_directory(path, key, self.config.skipclean.cursor(),
+                                     manifest)
+        manifest.close()
+        self.config.skipclean.close()
+
+    def clean(self, directories=None):
+        os.chdir(self.config.mirror_path)
 
-        i = 0
-        total = len(self.rm_files)
+        if directories is None:
+            directories = self.config.clean_directory
+        merge = isinstance(self.config.skipclean, KeepSet)
+        if merge:
+            self.merge_clean(directories)
+        else:
+            for path in directories:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    self.process_directory(path)
+            write_manifest(self.config.clean_manifest,
+                           self.config.mirror_path,
+                           self.rm_files, self.rm_dirs)
+            self.rm_count = len(self.rm_files)
+            self.rm_dir_count = len(self.rm_dirs)
+
+        total = self.rm_count
         size_output = format_bytes(self.unnecessary_bytes)
+        engine = CleanupEngine(threads=self.config.clean_threads,
+                               rate=float(self.config.clean_rate),
+                               throttle=self.throttle)
 
         if self.config._autoclean:
             print(size_output, "in", total, "files and",
-                  len(self.rm_dirs), "directories will be freed...")
-
-            for path in self.rm_files:
-                os.unlink(path)
-            for path in self.rm_dirs:
-                os.rmdir(path)
+                  self.rm_dir_count, "directories will be freed...")
+            engine.run(self.config.clean_manifest)
+            # pending removals (clean.sh) are not changes yet
+            if merge:
+                for kind, path in read_manifest(self.config.clean_manifest):
+                    if kind == 'f' and os.path.lexists(path):
+                        self.changes.discard(path)
+            for path, size in zip(self.rm_files, self.rm_sizes):
+                if not os.path.lexists(path):
+                    self.changes.removed(path, size)
         else:
             print(size_output, "in", total, "files and",
-                  len(self.rm_dirs), " directories can be freed.")
+                  self.rm_dir_count, " directories can be freed.")
             print("Run ", self.config.cleanscript, " for this purpose.\n")
 
+            package_dir = os.path.dirname(
+                os.path.dirname(os.path.abspath(__file__)))
+            script = open(self.config.cleanscript, 'w')
             script.write("#!/bin/sh\n")
-            script.write("set -e\n\n")
-            script.write(
-                "cd " + quoted_path(self.config.mirror_path) + "\n\n")
-            script.write("echo 'Removing %d unnecessary files [%s]...'\n" % (
-                total, size_output))
-            for filepath in self.rm_files:
-                script.write("rm -f '%s'\n" % filepath)
-                if i % 500 == 0:
-                    script.write(
-                        "echo -n '[" + str(int(100 * i / total)) + "%]'\n")
-                if i % 10 == 0:
-                    script.write("echo -n .\n")
-                i += 1
-            script.write("echo 'done.'\n")
-            script.write("echo\n\n")
-
-            i = 0
-            total = len(self.rm_dirs)
-            script.write(
-                "echo 'Removing %d unnecessary directories...'\n" % total)
-            for dirpath in self.rm_dirs:
-                script.write("if test -d '%s'; then rmdir '%s'; fi\n" %
-                             (dirpath, dirpath))
-                if i % 50 == 0:
-                    script.write(
-                        "echo -n '[" + str(int(100 * i / total)) + "%]'\n")
-                script.write("echo -n .\n")
-                i += 1
-            script.write("echo 'done.'\n")
-            script.write("echo\n")
-
+            script.write("# options: --dry-run, --threads N, --rate N\n")
+            priority = ''
+            if self.config.io_priority:
+                priority += ' --io-priority ' + \
+                    quoted_path(self.config.io_priority)
+            if self.config.cpu_nice:
+                priority += ' --nice %d' % self.config.cpu_nice
+            if self.config.disk_latency:
+                priority += ' --disk-latency %d' % self.config.disk_latency
+            script.write("PYTHONPATH=%s exec %s -m apt_mirror.cleanup "
+                         "--threads %d --rate %s%s \"$@\" %s\n" % (
+                             quoted_path(package_dir),
+                             quoted_path(sys.executable),
+                             self.config.clean_threads,
+                             self.config.clean_rate,
+                             priority,
+                             quoted_path(self.config.clean_manifest)))
             script.close()
 
-        # Make clean script executable
-        os.system('chmod a+x ' + self.config.cleanscript)
+            # Make clean script executable
+            os.chmod(self.config.cleanscript, 0o755)
+
+    def write_changes(self):
+        self.changes.write(self.config.change_manifest)
+        counts = self.changes.counts()
+        print(counts['A'], "files added,", counts['M'], "modified and",
+              counts['D'], "removed, see", self.config.change_manifest)
 
     def post(self):
         if not self.config.run_postmirror:
@@ -627,25 +1435,58 @@ class AptMirror(object):
         print("(" + post_script + ")\n")
 
         if os.path.isfile(post_script):
+            # the change manifest as APT_MIRROR_CHANGES and on stdin
+            env = dict(os.environ)
+            env['APT_MIRROR_CHANGES'] = self.config.change_manifest
             if os.access(post_script, os.X_OK):
-                os.system(post_script)
+                args = [post_script]
             else:
-                os.system('/bin/sh ' + post_script)
+                args = ['/bin/sh', post_script]
+            with open(self.config.change_manifest) as changes:
+                subprocess.call(args, stdin=changes, env=env)
         else:
             logging.warn('Postmirror script not found')
         print("\nPost Mirror script has completed. See above output for any possible errors.\n")
 
 
 def main():
-    config_file = "/etc/apt/mirror.list"
-    if len(sys.argv) > 1:
-        config_file = sys.argv[1]
+    parser = argparse.ArgumentParser(prog='apt-mirror')
+    parser.add_argument('config_file', nargs='?',
+                        default="/etc/apt/mirror.list")
+    parser.add_argument('--verify', action='store_true',
+                        help='check mirrored files against their checksums '
+                             'and download the broken ones again')
+    parser.add_argument('--worker', type=int, metavar='SHARD',
+                        help='download a shard of the archive planned by '
+                             'the coordinator (see "set shards")')
+    parser.add_argument('--profile', action='store_true',
+                        help='write cProfile and tracemalloc reports of '
+                             'every phase to $var_path/profile')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='write a timeline of phases, indexes and '
+                             'transfers to FILE (Chrome trace format)')
+    args = parser.parse_args()
+
+    config_file = args.config_file
     if not os.path.exists(config_file):
         print('apt-mirror: invalid config file specified')
         sys.exit(1)
 
-    apt_mirror = AptMirror(config_file)
-    apt_mirror.run()
+    apt_mirror = AptMirror(config_file, profile=args.profile,
+                           trace=args.trace)
+    lower_priority(apt_mirror.config.io_priority, apt_mirror.config.cpu_nice)
+    try:
+        if args.verify:
+            sys.exit(1 if apt_mirror.verify() else 0)
+        if args.worker is not None:
+            apt_mirror.run_worker(args.worker)
+            return
+        apt_mirror.run()
+    finally:
+        apt_mirror.close()
+        if apt_mirror.tracer is not None:
+            apt_mirror.tracer.write()
+            print("Trace is written to", args.trace)
 
 
 if __name__ == '__main__':
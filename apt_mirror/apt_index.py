@@ -3,7 +3,54 @@
 
 import os
 import re
+import hashlib
 import logging
+from .utils import sanitise_uri
+from .verify import read_checksums, verify_files, hash_file, VerifyState
+
+# the order process_index looks for a compressed index
+INDEX_COMPRESSIONS = ['.gz', '.xz', '.bz2', '']
+RELEASE_FILES = ['InRelease', 'Release', 'Release.gpg']
+
+
+def wanted_translation(filename, languages):
+    """
+    Translation-de_DE.bz2 is wanted for the languages "de" and "de_DE",
+    every translation is wanted when no languages are given
+    """
+    if not languages:
+        return True
+    match = re.search(r'Translation-([^./]+)', filename)
+    if not match:
+        return True
+    language = match.group(1)
+    return language in languages or language.split('_')[0] in languages
+
+
+def read_release_checksums(release_path):
+    """{file name: (SHA256, size)} of the SHA256 list of a Release file
+    """
+    checksums = {}
+    try:
+        release_file = open(release_path)
+    except IOError:
+        return checksums
+
+    in_sha256 = 0
+    for line in release_file.readlines():
+        line = line.rstrip()
+        if in_sha256:
+            if re.match(r'^ +(.*)', line):
+                parts = line.split()
+                if len(parts) == 3:
+                    digest, size, filename = parts
+                    checksums[filename] = (digest, int(size))
+                continue
+            in_sha256 = 0
+        if line == "SHA256:":
+            in_sha256 = 1
+    release_file.close()
+    return checksums
 
 
 class MirrorSkel(object):
@@ -11,22 +58,52 @@ class MirrorSkel(object):
     apt archive mirror skel
     """
 
-    def __init__(self, url, skel_path, data):
+    def __init__(self, url, skel_path, data, config=None):
         self.url = url
         self.skel_path = skel_path
         self.data = data
+        self.config = config
+        self.checksums = {}
         self.suites = []
         for suite in self.data:
             self.suites.append(SuiteSkel(mirror=self, suite=suite))
         return
 
     def check_md5(self):
-        # TODO:
-        return
+        """Check the mirrored files against the checksums from the last run,
+        return the store paths of the files that are missing or broken.
+        """
+        prefix = sanitise_uri(self.url) + '/'
+        self.checksums = read_checksums(self.config.var_path, prefix)
+        state = VerifyState(self.config.verify_state)
+        state.prune(prefix, self.checksums)
+        failed = verify_files(self.config.mirror_path, self.checksums, state,
+                              processes=self.config.verify_processes)
+        state.save()
+        return failed
 
-    def fix(self, filename, retry=0):
-        # TODO:
-        return
+    def fix(self, filename, retry=0, size=0):
+        """Download a broken file again, return True if it is good now.
+        size 0 is unknown, the checksum lists have none.
+        """
+        from . import download_urls
+        prefix = sanitise_uri(self.url) + '/'
+        key = (self.url, filename[len(prefix):])
+        algorithm, digest = self.checksums[filename]
+        path = os.path.join(self.config.mirror_path, filename)
+        for _attempt in range(retry + 1):
+            if os.path.exists(path):
+                # or wget -N would keep a broken file of the right size
+                os.unlink(path)
+            download_urls('fix', [key], context=self.config,
+                          sizes={key: size}, immutable=True,
+                          checksums={key: (algorithm, digest)},
+                          target_dir=self.config.mirror_path)
+            if hash_file((path, algorithm))[1] == digest:
+                return True
+        logging.warning('apt-mirror: %s is still broken after %d retries' %
+                        (filename, retry))
+        return False
 
     def get_indexes(self, contents=False):
         index_list = []
@@ -51,6 +128,7 @@ class SuiteSkel(object):
         self.skel_path = self.mirror.skel_path + '/' + self.rel_path
         self.sources = []
         self.packages = []
+        self.checksums = None
         return
 
     def compressed_index(self, rel_path):
@@ -64,9 +142,84 @@ class SuiteSkel(object):
             self.packages.append(self.skel_path + '/' + rel_path)
         return [path] + [path + ext for ext in COMPRESSIONS]
 
+    def release_checksums(self):
+        """SHA256 and size of every file listed in the Release file, keyed by
+        the file name relative to the suite.
+        """
+        if self.checksums is None:
+            self.checksums = read_release_checksums(
+                os.path.join(self.skel_path, 'Release'))
+        return self.checksums
+
+    def acquire_by_hash(self):
+        """True if the Release file says that the indexes can be fetched
+        from by-hash/SHA256/<digest> next to them.
+        """
+        try:
+            release_file = open(os.path.join(self.skel_path, 'Release'))
+        except IOError:
+            return False
+        by_hash = False
+        for line in release_file:
+            if line.startswith(' '):
+                # the checksum lists come after the header fields
+                break
+            key, _sep, value = line.partition(':')
+            if key.strip().lower() == 'acquire-by-hash':
+                by_hash = value.strip().lower() == 'yes'
+        release_file.close()
+        return by_hash
+
+    def previous_by_hash_paths(self, mirror_path):
+        """The by-hash paths of the Release file still published in
+        mirror_path, which clients may hold until they update.
+        """
+        checksums = read_release_checksums(
+            os.path.join(mirror_path, sanitise_uri(self.url), 'Release'))
+        return [os.path.join(self.rel_path, os.path.dirname(name),
+                             'by-hash/SHA256', digest)
+                for name, (digest, size) in checksums.items()]
+
+    def by_hash_path(self, rel_path):
+        """Return (by-hash path, SHA256, size) of an index listed in the
+        Release file, or None.
+        """
+        checksums = self.release_checksums()
+        name = rel_path[len(self.rel_path) + 1:]
+        if name not in checksums:
+            return None
+        digest, size = checksums[name]
+        return (os.path.join(self.rel_path, os.path.dirname(name),
+                             'by-hash/SHA256', digest), digest, size)
+
+    def index_checksum(self, index_path):
+        """Return the (local file, SHA256) of the index file process_index
+        would read, or (local file, None) if it does not match Release.
+        """
+        checksums = self.release_checksums()
+        rel_name = index_path[len(self.skel_path) + 1:]
+        for ext in INDEX_COMPRESSIONS:
+            local_file = index_path + ext
+            if not os.path.exists(local_file):
+                continue
+            if rel_name + ext not in checksums:
+                return local_file, None
+            digest, size = checksums[rel_name + ext]
+            if os.path.getsize(local_file) != size:
+                return local_file, None
+            sha256 = hashlib.sha256()
+            with open(local_file, 'rb') as fp:
+                for block in iter(lambda: fp.read(1 << 20), b''):
+                    sha256.update(block)
+            if sha256.hexdigest() != digest:
+                return local_file, None
+            return local_file, digest
+        return None, None
+
     def get_indexes(self, contents=False):
-        index_list = [os.path.join(self.rel_path, fn) for fn in [
-            'InRelease', 'Release', 'Release.gpg']]  # Release
+        self.checksums = None
+        index_list = [os.path.join(self.rel_path, fn)
+                      for fn in RELEASE_FILES]  # Release
         # other index
         for component, arch_list in self.components.items():
             for arch in arch_list:
@@ -95,7 +248,7 @@ class SuiteSkel(object):
                                 component + '/Contents-' + arch)
         return index_list
 
-    def find_translation_files_in_release(self, components):
+    def find_translation_files_in_release(self, components, languages=None):
         """Look in the dists/DIST/Release file for the translation files that belong
         to the given component.
         """
@@ -115,7 +268,8 @@ class SuiteSkel(object):
                     parts = line.split()
                     if len(parts) == 3:
                         _sha1, size, filename = parts
-                        if re.match('^(' + '|'.join(components) + r')/i18n/Translation-[^./]*\.bz2', filename):
+                        if re.match('^(' + '|'.join(components) + r')/i18n/Translation-[^./]*\.bz2', filename) \
+                                and wanted_translation(filename, languages):
                             files[os.path.join(
                                 self.rel_path, filename)] = int(size)
                     else:
@@ -129,10 +283,10 @@ class SuiteSkel(object):
         release_file.close()
         return files
 
-    def find_translation_files_in_index(self):
+    def find_translation_files_in_index(self, languages=None):
         # Extract all translation files from the dists/DIST/COMPONENT/i18n/Index
         # file. Fall back to parsing dists/DIST/Release if i18n/Index is not
-        # found.
+        # found. Only the given languages are returned, if any.
         if self.simple:
             return {}
 
@@ -157,8 +311,9 @@ class SuiteSkel(object):
                         parts = line.split()
                         if len(parts) == 3:
                             _checksum, size, filename = parts
-                            files[os.path.join(
-                                self.rel_path, i18n_dir, filename)] = int(size)
+                            if wanted_translation(filename, languages):
+                                files[os.path.join(
+                                    self.rel_path, i18n_dir, filename)] = int(size)
                         else:
                             logging.warn("Malformed checksum line \"%s\" in %s" %
                                          (line, index_url))
@@ -172,7 +327,7 @@ class SuiteSkel(object):
 
         if not_found:
             files.update(self.find_translation_files_in_release(
-                components=not_found))
+                components=not_found, languages=languages))
 
         return files
 
@@ -0,0 +1,57 @@
+#!/usr/bin/env python2
+# coding:utf-8
+"""
+The change manifest of a run: what downstream mirrors have to sync.
+
+One line per store path (relative to mirror_path), sorted by path, tab
+separated:
+    STATUS  SIZE  DIGEST  PATH
+STATUS is A (added), M (modified) or D (removed). DIGEST is
+"sha256:<hex>" or "md5:<hex>", "-" if it is not known; removed files
+have no digest. "cut -f4" gives a list for rsync --files-from.
+"""
+
+import os
+import threading
+
+
+class ChangeManifest(object):
+    """
+    store paths added, modified and removed during a run
+    """
+
+    def __init__(self):
+        self.changes = {}
+        self.lock = threading.Lock()
+        return
+
+    def add(self, status, path, size, checksum=None):
+        digest = '-'
+        if checksum:
+            digest = '%s:%s' % checksum
+        with self.lock:
+            self.changes[path] = (status, size, digest)
+
+    def added(self, path, size, checksum=None, existed=False):
+        self.add('M' if existed else 'A', path, size, checksum)
+
+    def removed(self, path, size):
+        self.add('D', path, size)
+
+    def discard(self, path):
+        with self.lock:
+            self.changes.pop(path, None)
+
+    def counts(self):
+        counts = {'A': 0, 'M': 0, 'D': 0}
+        for status, _size, _digest in self.changes.values():
+            counts[status] += 1
+        return counts
+
+    def write(self, manifest_file):
+        tmp_file = manifest_file + '.tmp'
+        with open(tmp_file, 'w') as fp:
+            for path in sorted(self.changes):
+                status, size, digest = self.changes[path]
+                fp.write('%s\t%d\t%s\t%s\n' % (status, size, digest, path))
+        os.rename(tmp_file, manifest_file)
@@ -0,0 +1,239 @@
+#!/usr/bin/env python2
+# coding:utf-8
+"""
+Bulk removal of the files and directories apt-mirror does not need.
+
+The removal manifest is a list of NUL terminated records, the first
+character of each record is its type:
+    b   base directory, the other paths are relative to it
+    f   file to unlink
+    d   directory to remove if it is empty
+
+Usage: python -m apt_mirror.cleanup [--dry-run] [--threads N] [--rate N] MANIFEST
+"""
+
+from __future__ import print_function
+import argparse
+import errno
+import os
+import sys
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class ManifestWriter(object):
+    """
+    write a removal manifest record by record; it is put in place by
+    close()
+    """
+
+    def __init__(self, manifest_file, base_dir):
+        self.manifest_file = manifest_file
+        self.tmp_file = manifest_file + '.tmp'
+        self.fp = open(self.tmp_file, 'wb')
+        self.write('b', base_dir)
+        return
+
+    def write(self, kind, path):
+        record = kind + path + '\0'
+        if not isinstance(record, bytes):
+            record = record.encode('utf-8', 'surrogateescape')
+        self.fp.write(record)
+
+    def close(self):
+        self.fp.close()
+        os.rename(self.tmp_file, self.manifest_file)
+
+
+def write_manifest(manifest_file, base_dir, files, dirs):
+    writer = ManifestWriter(manifest_file, base_dir)
+    for kind, paths in (('f', files), ('d', dirs)):
+        for path in paths:
+            writer.write(kind, path)
+    writer.close()
+
+
+def read_manifest(manifest_file, block_size=1 << 16):
+    """
+    yield (type, path) records without reading the whole manifest
+    """
+    rest = b''
+    with open(manifest_file, 'rb') as fp:
+        for block in iter(lambda: fp.read(block_size), b''):
+            records = (rest + block).split(b'\0')
+            rest = records.pop()
+            for record in records:
+                if record:
+                    if not isinstance(record, str):
+                        record = record.decode('utf-8', 'surrogateescape')
+                    yield record[0], record[1:]
+
+
+class RateLimiter(object):
+    """
+    at most rate operations per second over all threads, 0 for no limit
+    """
+
+    def __init__(self, rate=0):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_time = time.time()
+        self.lock = threading.Lock()
+        return
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class CleanupEngine(object):
+    """
+    unlink files with a pool of threads, then remove directories deepest
+    first
+    """
+
+    def __init__(self, threads=4, dry_run=False, rate=0, throttle=None):
+        self.threads = max(1, threads)
+        self.dry_run = dry_run
+        self.limiter = RateLimiter(rate)
+        self.throttle = throttle
+        self.lock = threading.Lock()
+        self.files = 0
+        self.dirs = 0
+        self.bytes = 0
+        self.errors = 0
+        return
+
+    def remove_file(self, path):
+        self.limiter.wait()
+        if self.throttle is not None:
+            self.throttle.backoff()
+        try:
+            st = os.lstat(path)
+            if not self.dry_run:
+                os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                print("apt-mirror: can't remove %s: %s" % (path, e))
+                with self.lock:
+                    self.errors += 1
+            return
+        with self.lock:
+            self.files += 1
+            self.bytes += st.st_blocks * 512
+
+    def remove_dir(self, path):
+        self.limiter.wait()
+        if self.throttle is not None:
+            self.throttle.backoff()
+        try:
+            if not self.dry_run:
+                os.rmdir(path)
+        except OSError as e:
+            # a directory that is not empty (any more) is simply kept
+            if e.errno not in (errno.ENOENT, errno.ENOTEMPTY, errno.EEXIST):
+                print("apt-mirror: can't remove %s: %s" % (path, e))
+                with self.lock:
+                    self.errors += 1
+            return
+        with self.lock:
+            self.dirs += 1
+
+    def _worker(self, tasks):
+        while 1:
+            item = tasks.get()
+            if item is None:
+                break
+            func, path = item
+            func(path)
+
+    def _run_pool(self, items):
+        tasks = queue.Queue(maxsize=self.threads * 64)
+        workers = []
+        for _i in range(self.threads):
+            worker = threading.Thread(target=self._worker, args=(tasks,))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        for item in items:
+            tasks.put(item)
+        for worker in workers:
+            tasks.put(None)
+        for worker in workers:
+            worker.join()
+
+    def run(self, manifest_file):
+        base_dir = '.'
+        dirs = []
+
+        def file_tasks():
+            for kind, path in read_manifest(manifest_file):
+                if kind == 'b':
+                    continue
+                elif kind == 'f':
+                    yield self.remove_file, os.path.join(base_dir, path)
+                elif kind == 'd':
+                    dirs.append(os.path.join(base_dir, path))
+
+        for kind, path in read_manifest(manifest_file):
+            if kind == 'b':
+                base_dir = path
+            break
+        self._run_pool(file_tasks())
+
+        # deepest directories first, one depth level at a time so that a
+        # parent is never removed before its children
+        by_depth = {}
+        for path in dirs:
+            by_depth.setdefault(path.count('/'), []).append(path)
+        for depth in sorted(by_depth, reverse=True):
+            self._run_pool((self.remove_dir, path) for path in by_depth[depth])
+        return self.files, self.dirs, self.bytes
+
+
+def main():
+    from .utils import format_bytes
+    from .iopriority import IOThrottle, lower_priority
+    parser = argparse.ArgumentParser(prog='apt-mirror-cleanup')
+    parser.add_argument('manifest')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only count what would be removed')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=0,
+                        help='maximum removals per second, 0 for no limit')
+    parser.add_argument('--io-priority', default='',
+                        help='I/O class like "idle" or "best-effort:7"')
+    parser.add_argument('--nice', type=int, default=0)
+    parser.add_argument('--disk-latency', type=int, default=0,
+                        help='hold back while the disk needs more ms per '
+                             'request, 0 for no limit')
+    args = parser.parse_args()
+
+    lower_priority(args.io_priority, args.nice)
+    throttle = None
+    if args.disk_latency:
+        for kind, path in read_manifest(args.manifest):
+            # the base directory
+            throttle = IOThrottle(latency=args.disk_latency, path=path)
+            break
+    engine = CleanupEngine(threads=args.threads, dry_run=args.dry_run,
+                           rate=args.rate, throttle=throttle)
+    files, dirs, freed = engine.run(args.manifest)
+    print("%s %s in %d files and %d directories." % (
+        'Would free' if args.dry_run else 'Freed',
+        format_bytes(freed), files, dirs))
+    if engine.errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python2
+# coding:utf-8
+
+import array
+import logging
+import re
+
+# version restrictions, architecture qualifiers and build profiles
+DEPENDENCY_NOISE = re.compile(r'\([^)]*\)|\[[^\]]*\]|<[^>]*>')
+PACKAGES_ARCH = re.compile(r'/binary-([^/]+)/Packages$')
+
+
+def read_seeds(seed_file):
+    seeds = []
+    with open(seed_file) as fp:
+        for line in fp.readlines():
+            line = line.split('#', 1)[0].strip()
+            if line:
+                seeds.extend(line.split())
+    return seeds
+
+
+def parse_relations(value):
+    """
+    "a (>= 1) | b:any, c [amd64]" -> [['a', 'b'], ['c']]
+    """
+    groups = []
+    for group in DEPENDENCY_NOISE.sub('', value).split(','):
+        alternatives = [alt.strip().split(':')[0] for alt in group.split('|')]
+        alternatives = [alt for alt in alternatives if alt]
+        if alternatives:
+            groups.append(alternatives)
+    return groups
+
+
+def index_arch(index_path):
+    """
+    architecture of a Packages index, None for flat archives
+    """
+    match = PACKAGES_ARCH.search(index_path)
+    if match:
+        return match.group(1)
+    return None
+
+
+class DependencyGraph(object):
+    """
+    package names of one architecture as integer ids, with an adjacency
+    array of resolved dependencies
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.ids = {}
+        self.names = []
+        self.relations = []
+        self.providers = {}
+        return
+
+    def package_id(self, name):
+        pkg_id = self.ids.get(name)
+        if pkg_id is None:
+            pkg_id = self.ids[name] = len(self.names)
+            self.names.append(name)
+            self.relations.append([])
+        return pkg_id
+
+    def add(self, entry):
+        name = entry.get('Package')
+        if not name:
+            return
+        pkg_id = self.package_id(name)
+        for field in self.fields:
+            if field in entry:
+                self.relations[pkg_id].extend(parse_relations(entry[field]))
+        if 'Provides' in entry:
+            for group in parse_relations(entry['Provides']):
+                providers = self.providers.setdefault(group[0], [])
+                if pkg_id not in providers:
+                    providers.append(pkg_id)
+
+    def resolve(self, alternatives):
+        # like apt, prefer the first alternative that can be installed
+        for name in alternatives:
+            if name in self.ids:
+                return self.ids[name]
+            if name in self.providers:
+                return self.providers[name][0]
+        return None
+
+    def closure(self, seeds):
+        # adjacency in two flat arrays: edges[offsets[i]:offsets[i + 1]]
+        offsets = array.array('i', [0])
+        edges = array.array('i')
+        for groups in self.relations:
+            for group in groups:
+                target = self.resolve(group)
+                if target is not None:
+                    edges.append(target)
+            offsets.append(len(edges))
+        self.relations = None
+
+        visited = bytearray(len(self.names))
+        stack = []
+        for seed in seeds:
+            pkg_id = self.resolve([seed])
+            if pkg_id is not None and not visited[pkg_id]:
+                visited[pkg_id] = 1
+                stack.append(pkg_id)
+        while stack:
+            pkg_id = stack.pop()
+            for target in edges[offsets[pkg_id]:offsets[pkg_id + 1]]:
+                if not visited[target]:
+                    visited[target] = 1
+                    stack.append(target)
+        return set(name for pkg_id, name in enumerate(self.names)
+                   if visited[pkg_id])
+
+
+class DependencyClosure(object):
+    """
+    the packages reachable from a list of seed packages, per architecture
+    """
+
+    def __init__(self, seeds, recommends=False):
+        self.seeds = seeds
+        self.fields = ['Pre-Depends', 'Depends']
+        if recommends:
+            self.fields.append('Recommends')
+        self.graphs = {}
+        self.flat_entries = []
+        self.source_of = {}
+        self.selected = {}
+        self.sources = set()
+        return
+
+    def add_index(self, index_path, entries):
+        if index_path.endswith('/Sources'):
+            return
+        arch = index_arch(index_path)
+        if arch is None:
+            entries = list(entries)
+            self.flat_entries.extend(entries)
+        elif arch not in self.graphs:
+            self.graphs[arch] = DependencyGraph(self.fields)
+        for entry in entries:
+            if arch is not None:
+                self.graphs[arch].add(entry)
+            name = entry.get('Package')
+            source = entry.get('Source', name) or ''
+            self.source_of.setdefault(name, set()).add(source.split(' ')[0])
+
+    def compute(self):
+        if not self.graphs:
+            self.graphs[None] = DependencyGraph(self.fields)
+        for graph in self.graphs.values():
+            # packages of flat archives are installable on every arch
+            for entry in self.flat_entries:
+                graph.add(entry)
+        self.flat_entries = []
+
+        found = set()
+        for arch, graph in self.graphs.items():
+            self.selected[arch] = graph.closure(self.seeds)
+            found.update(self.selected[arch])
+        self.graphs = {}
+        for seed in self.seeds:
+            if seed not in found:
+                logging.warn('apt-mirror: seed package %s not found' % seed)
+
+        # source packages of the selected binaries
+        for name in found:
+            self.sources.update(self.source_of.get(name, ()))
+        self.source_of = {}
+        return found
+
+    def match(self, index_path, entry):
+        name = entry.get('Package')
+        if index_path.endswith('/Sources'):
+            return name in self.sources
+        arch = index_arch(index_path)
+        if arch is None:
+            return any(name in names for names in self.selected.values())
+        return name in self.selected.get(arch, ())
@@ -4,6 +4,8 @@
 import os
 import re
 
+from .utils import sanitise_uri, remove_double_slashes
+
 CONFIG_VAR_PATTERN = re.compile(
     r'set[\t ]+(?P<key>[^\s]+)[\t ]+(?P<value>"[^"]+"|\'[^\']+\'|[^\s]+)')
 CONFIG_MIRROR_PATTERN = re.compile(r"""
@@ -18,6 +20,15 @@ CONFIG_MIRROR_PATTERN = re.compile(r"""
     """, re.X)
 CONFIG_CLEAN_PATTERN = re.compile(
     r'(?P<type>clean|skip-clean)[\t ]+(?P<uri>[^\s]+)')
+CONFIG_FILTER_PATTERN = re.compile(r"""
+    ^[\t ]*
+    (?P<type>include|exclude)
+    [\t ]+
+    (?P<uri>[^\s]+)
+    (?:[\t ]+(?P<suite>[^\s:]+))?
+    [\t ]+
+    (?P<field>name|regex|section|priority):(?P<pattern>[^\s]+)
+    """, re.X)
 
 
 def parse_config_line(line):
@@ -43,6 +54,10 @@ def parse_config_line(line):
             match = CONFIG_CLEAN_PATTERN.match(line)
             if match:
                 config = match.groupdict()
+            else:
+                match = CONFIG_FILTER_PATTERN.match(line)
+                if match:
+                    config = match.groupdict()
 
     return config
 
@@ -52,21 +67,61 @@ class MirrorConfig(object):
         default_arch = os.popen('dpkg --print-architecture').read().strip()
         self.vars = {"defaultarch": default_arch or 'i386',
                      "nthreads": '20',
+                     "metadata_jobs": '4',
+                     "lock_scope": 'global',
+                     "mirror_jobs": '4',
                      "use_queue": '0',
                      "base_path": '/var/spool/apt-mirror',
                      "mirror_path": '$base_path/mirror',
                      "skel_path": '$base_path/skel',
                      "var_path": '$base_path/var',
                      "cleanscript": '$var_path/clean.sh',
+                     "clean_manifest": '$var_path/clean.manifest',
+                     "clean_threads": '4',
+                     "clean_rate": '0',
+                     "clean_method": 'walk',
+                     "io_priority": '',
+                     "cpu_nice": '0',
+                     "disk_writers": '0',
+                     "disk_latency": '0',
+                     "verify_state": '$var_path/verify.state',
+                     "verify_processes": '0',
+                     "verify_retries": '3',
+                     "shards": '0',
+                     "shard_path": '$var_path/shards',
+                     "shard_local_workers": '0',
+                     "shard_timeout": '0',
+                     "index_cache": '$var_path/index-cache',
                      "_contents": '1',
                      "_autoclean": '0',
+                     "closure_seeds": '',
+                     "closure_recommends": '0',
+                     "keep_versions": '0',
                      "_tilde": '0',
+                     "languages": '',
+                     "seed_paths": '',
+                     "seed_link": '1',
                      "limit_rate": '100m',
+                     "limit_rate_hosts": '',
+                     "limit_rate_schedule": '',
+                     "downloader": 'wget',
+                     "hedge_ratio": '0.1',
+                     "hedge_after": '30',
+                     "hedge_hosts": '',
+                     "segments": '4',
+                     "segment_threshold": '256m',
+                     "sync_interval": '5',
+                     "sync_batch": '256',
+                     "sync_stages": '0',
+                     "progress": 'auto',
+                     "progress_events": '',
+                     "progress_interval": '2',
                      "run_postmirror": '1',
                      "auth_no_challenge": '0',
                      "no_check_certificate": '0',
                      "unlink": '0',
                      "postmirror_script": '$var_path/postmirror.sh',
+                     "change_manifest": '$var_path/changes',
                      "use_proxy": 'off',
                      "http_proxy": '',
                      "https_proxy": '',
@@ -75,6 +130,7 @@ class MirrorConfig(object):
         self.mirrors = {}
         self.skipclean = {}
         self.clean_directory = {}
+        self.package_filters = []
         if config_file:
             self.read(config_file)
         return
@@ -94,7 +150,15 @@ class MirrorConfig(object):
             else:
                 break
         # int variables
-        if key in ['nthreads', 'use_queue', '_contents', '_autoclean', '_tilde',
+        if key in ['nthreads', 'metadata_jobs', 'mirror_jobs', 'use_queue',
+                   'verify_processes', 'verify_retries',
+                   'shards', 'shard_local_workers', 'shard_timeout',
+                   'clean_threads', 'hedge_after', 'segments',
+                   'cpu_nice', 'disk_writers', 'disk_latency',
+                   'sync_interval', 'sync_batch', 'sync_stages',
+                   'seed_link',
+                   '_contents', '_autoclean',
+                   'closure_recommends', 'keep_versions', '_tilde',
                    'run_postmirror', 'auth_no_challenge',
                    'no_check_certificate', 'unlink']:
             try:
@@ -104,6 +168,23 @@ class MirrorConfig(object):
 
         return value
 
+    def mirror_state_path(self, url):
+        # lock_scope mirror: $var_path/mirrors/<host_path>
+        return os.path.join(self.var_path, 'mirrors',
+                            sanitise_uri(url).rstrip('/').replace('/', '_'))
+
+    def scoped(self, var_path):
+        """
+        a copy of the config whose $var_path is var_path; mirrors,
+        skipclean and the other parsed data are shared
+        """
+        # not copy.copy(), __getattribute__ would answer its lookups
+        config = MirrorConfig.__new__(MirrorConfig)
+        config.__dict__.update(self.__dict__)
+        config.vars = dict(self.vars)
+        config.vars['var_path'] = var_path
+        return config
+
     def __getattribute__(self, attr):
         try:
             return object.__getattribute__(self, attr)
@@ -170,7 +251,7 @@ class MirrorConfig(object):
                 continue
             elif config_line['type'] in ['skip-clean', 'clean']:
                 link = config_line['uri']
-                link = link.split('://', 1)[1].rstrip('/')
+                link = link.split('://', 1)[1].strip('/')
                 if self._tilde:
                     link = link.replace('~', '%7E')
                 if config_line['type'] == "skip-clean":
@@ -178,6 +259,18 @@ class MirrorConfig(object):
                 elif config_line['type'] == "clean":
                     self.clean_directory[link] = 1
                 continue
+            elif config_line['type'] in ['include', 'exclude']:
+                # the url as the mirror urls are stored, get_package_filter
+                # compares them
+                url = remove_double_slashes(config_line['uri']).rstrip('/')
+                if self._tilde:
+                    url = url.replace('~', '%7E')
+                self.package_filters.append((url,
+                                             config_line['suite'],
+                                             config_line['type'],
+                                             config_line['field'],
+                                             config_line['pattern']))
+                continue
 
             raise Exception(
                 "apt-mirror: invalid line in config file (%d: %s ...)" % (line_number, line))
@@ -185,3 +278,9 @@ class MirrorConfig(object):
         if not self.defaultarch:
             raise Exception(
                 "Please explicitly specify 'defaultarch' in mirror.list")
+
+        if self.lock_scope == 'mirror' and self.shards > 0:
+            # the workers would wait in the shard_path of the whole run, the
+            # mirrors plan in shard_paths of their own
+            raise Exception(
+                "apt-mirror: shards need lock_scope global")
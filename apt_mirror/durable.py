@@ -0,0 +1,131 @@
+#!/usr/bin/env python2
+# coding:utf-8
+"""
+Durable downloads without one fsync per file.
+
+A downloaded file is written to a temp file next to its final path.
+DurableWriter collects them and, every interval seconds or every batch
+files, fsyncs the temp files, renames them into place and fsyncs their
+directories once. After a crash a file is either complete at its final
+path or not there at all, never torn.
+"""
+
+import ctypes
+import logging
+import os
+import subprocess
+import threading
+
+
+def fsync_path(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        # some filesystems can't fsync directories
+        pass
+    finally:
+        os.close(fd)
+
+
+def sync_filesystem(path):
+    """
+    one syncfs(2) of the filesystem of path for the files written in place
+    (wget, rsync, local copies), sync(2) where there is no syncfs
+    """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if libc.syncfs(fd) == 0:
+                return
+        finally:
+            os.close(fd)
+    except (OSError, AttributeError):
+        pass
+    if hasattr(os, 'sync'):
+        os.sync()
+    else:
+        subprocess.call(['sync'])
+
+
+def preallocate(fp, size):
+    if not size:
+        return
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fp.fileno(), 0, size)
+            return
+        except OSError:
+            pass
+    fp.truncate(size)
+
+
+class DurableWriter(object):
+    """
+    rename temp files into place in fsynced batches
+    """
+
+    def __init__(self, interval=5, batch=256, throttle=None):
+        self.interval = interval
+        self.batch = batch
+        self.throttle = throttle
+        self.pending = []
+        self.lock = threading.Lock()
+        # one batch at a time
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return
+
+    def place(self, tmp_path, path):
+        with self.lock:
+            self.pending.append((tmp_path, path))
+            if len(self.pending) >= self.batch:
+                self.wakeup.set()
+
+    def _run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # later batches still have to be placed
+                logging.warning('apt-mirror: durable writer: %s' % e)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, []
+            if not pending:
+                return
+            if self.throttle is not None:
+                # a batch of fsyncs is what hurts a busy disk most
+                self.throttle.backoff()
+            for tmp_path, path in pending:
+                fsync_path(tmp_path)
+            directories = set()
+            for tmp_path, path in pending:
+                try:
+                    os.rename(tmp_path, path)
+                except OSError as e:
+                    # left missing, the size check after the stage reports it
+                    logging.warning("apt-mirror: can't place %s: %s"
+                                    % (path, e))
+                    continue
+                directories.add(os.path.dirname(path))
+            for directory in directories:
+                fsync_path(directory)
+
+    def close(self):
+        self.stopped = True
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
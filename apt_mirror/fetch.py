@@ -0,0 +1,593 @@
+#!/usr/bin/env python2
+# coding:utf-8
+"""
+In-process HTTP(S)/FTP downloader.
+
+Unlike wget children, every transfer runs in this process, so that all of
+them can share one bandwidth limiter and report their bytes as they arrive.
+"""
+
+import base64
+import calendar
+import email.utils
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+try:
+    import urllib.request as urllib_request
+    from urllib.error import HTTPError, URLError
+    from urllib.parse import urlsplit, urlunsplit, unquote
+except ImportError:
+    import urllib2 as urllib_request
+    from urllib2 import HTTPError, URLError
+    from urlparse import urlsplit, urlunsplit
+    from urllib import unquote
+
+from .utils import sanitise_uri, url_host
+from .verify import hash_file
+from .durable import preallocate
+
+CHUNK_SIZE = 64 << 10
+TIMEOUT = 900
+RETRIES = 5
+
+
+class FetchError(Exception):
+    """
+    a download that arrived broken, it is worth another try
+    """
+
+
+class Cancelled(Exception):
+    """
+    another request for the same file finished first
+    """
+
+
+class NoRange(Exception):
+    """
+    the server sent the whole file for a Range request
+    """
+
+
+class Transfer(object):
+    """
+    one file being downloaded, by its own request and maybe a hedged
+    duplicate; the first to finish is kept
+    """
+
+    def __init__(self, url, path, size, immutable=False, checksum=None):
+        self.url = url
+        self.path = path
+        self.size = size
+        self.immutable = immutable
+        self.checksum = checksum
+        self.started = time.time()
+        # response headers of the first request that got one, for --trace
+        self.first_byte = None
+        self.attempts = 0
+        self.not_modified = False
+        # bytes of the first request, the one reported to progress
+        self.received = 0
+        # the thread of the hedged request, and why it failed
+        self.hedged = None
+        self.hedge_error = None
+        self.done = False
+        self.lock = threading.Lock()
+        return
+
+    def throughput(self):
+        elapsed = time.time() - self.started
+        if elapsed <= 0:
+            return 0.0
+        return self.received / elapsed
+
+
+class Fetcher(object):
+    """
+    download urls below a target directory, like wget -r -N does
+    """
+
+    def __init__(self, context, limiter=None, progress=None, stage=None,
+                 logfile=None, segments=1, segment_threshold=0, writer=None,
+                 tracer=None, throttle=None):
+        self.limiter = limiter
+        self.tracer = tracer
+        # an IOThrottle caps the files written back to disk at once
+        self.throttle = throttle
+        # a DurableWriter puts the finished files in place, else they are
+        # renamed at once
+        self.writer = writer
+        # files from segment_threshold bytes up are fetched as segments
+        # parallel Range requests
+        self.segments = segments
+        self.segment_threshold = segment_threshold
+        self.progress = progress
+        self.stage = stage
+        self.log_lock = threading.Lock()
+        self.log = open(logfile, 'a') if logfile else None
+        self.opener = self.build_opener(context)
+        self.lock = threading.Lock()
+        # running transfers and the throughput of the finished ones
+        self.active = {}
+        self.rates = []
+        self.completed = 0
+        self.changed = threading.Condition(self.lock)
+        return
+
+    @staticmethod
+    def build_opener(context):
+        handlers = []
+        if context.use_proxy in ('yes', 'on'):
+            proxies = {}
+            for schema, proxy in (('http', context.http_proxy),
+                                  ('https', context.https_proxy)):
+                if not proxy:
+                    continue
+                if '://' not in proxy:
+                    proxy = 'http://' + proxy
+                if context.proxy_user:
+                    schema_part, rest = proxy.split('://', 1)
+                    proxy = '%s://%s:%s@%s' % (schema_part, context.proxy_user,
+                                               context.proxy_password, rest)
+                proxies[schema] = proxy
+            handlers.append(urllib_request.ProxyHandler(proxies))
+        if context.no_check_certificate == 1:
+            import ssl
+            ssl_context = ssl.create_default_context()
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+            handlers.append(urllib_request.HTTPSHandler(context=ssl_context))
+        return urllib_request.build_opener(*handlers)
+
+    def write_log(self, message):
+        if self.log is not None:
+            with self.log_lock:
+                self.log.write('%s %s\n' % (time.strftime('%c'), message))
+                self.log.flush()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.log is not None:
+            self.log.close()
+
+    @contextmanager
+    def open_tmp(self, tmp_path):
+        """
+        the temp file of a transfer: with an IOThrottle it waits for the
+        disk once before it is opened and writes the file back in a writer
+        slot once it is complete
+        """
+        if self.throttle is not None:
+            self.throttle.backoff()
+        with open(tmp_path, 'wb') as fp:
+            yield fp
+            if self.throttle is not None:
+                self.throttle.write_back(fp)
+
+    def request(self, url, headers=None):
+        parts = urlsplit(url)
+        headers = dict(headers or {})
+        netloc = parts.netloc
+        if '@' in netloc:
+            # credentials in the url are always sent, like --auth-no-challenge
+            userinfo, netloc = netloc.rsplit('@', 1)
+            token = base64.b64encode(unquote(userinfo).encode('utf-8'))
+            headers['Authorization'] = 'Basic ' + token.decode('ascii')
+        url = urlunsplit((parts.scheme, netloc, parts.path, parts.query, ''))
+        return urllib_request.Request(url, headers=headers)
+
+    def fetch(self, url, target_dir, size=0, immutable=False, checksum=None):
+        """
+        download url to target_dir/sanitise_uri(url), return True on success
+
+        An immutable file (anything listed in a Packages/Sources index) is
+        never revalidated: one plain GET, checked against its size and
+        checksum from the index.
+        """
+        transfer = Transfer(url, os.path.join(target_dir, sanitise_uri(url)),
+                            size, immutable, checksum)
+        with self.lock:
+            self.active[url] = transfer
+        if self.tracer is not None:
+            self.tracer.transfer(url_host(url), 1)
+        segmented = self.segmented(transfer)
+        try:
+            for attempt in range(RETRIES):
+                transfer.attempts += 1
+                try:
+                    if segmented:
+                        return self._fetch_segments(transfer, url)
+                    return self._fetch(transfer, url)
+                except NoRange:
+                    self.write_log('%s: no Range support' % url)
+                    segmented = False
+                    continue
+                except Cancelled:
+                    return True
+                except HTTPError as e:
+                    self.write_log('%s: %s %s' % (url, e.code, e.msg))
+                    if e.code < 500:
+                        break
+                except (FetchError, URLError, socket.error,
+                        EnvironmentError) as e:
+                    self.write_log('%s: %s' % (url, e))
+                except Exception as e:
+                    # IncompleteRead, BadStatusLine, a bad url...: an
+                    # escaping error would kill the worker thread
+                    self.write_log('%s: %s: %s' % (url, type(e).__name__, e))
+                time.sleep(min(2 ** attempt, 30))
+                if transfer.done:
+                    # a hedged request made it meanwhile
+                    return True
+            if transfer.hedged is not None:
+                transfer.hedged.join()
+                if transfer.done:
+                    return True
+            logging.warning('apt-mirror: failed to download %s' % url)
+            self.done(url_host(url), 0)
+            self.complete()
+            return False
+        finally:
+            with self.lock:
+                self.active.pop(url, None)
+                if transfer.size:
+                    self.rates.append(transfer.throughput())
+            if self.tracer is not None:
+                self.trace(transfer, segmented)
+
+    def trace(self, transfer, segmented):
+        host = url_host(transfer.url)
+        outcome = 'done' if transfer.done else 'failed'
+        if transfer.not_modified:
+            outcome = 'not modified'
+        args = {'url': transfer.url, 'host': host, 'size': transfer.size,
+                'outcome': outcome,
+                'attempts': transfer.attempts}
+        if transfer.first_byte is not None:
+            args['first_byte_ms'] = int(
+                (transfer.first_byte - transfer.started) * 1000)
+        if transfer.hedged is not None:
+            args['hedged'] = True
+        if transfer.hedge_error is not None:
+            args['hedge_error'] = transfer.hedge_error
+        if segmented:
+            args['segments'] = self.segments
+        self.tracer.complete(os.path.basename(transfer.path), 'transfer',
+                             transfer.started, args=args)
+        self.tracer.transfer(host, -1)
+
+    def complete(self):
+        with self.lock:
+            self.completed += 1
+            self.changed.notify_all()
+
+    def wait(self, count, workers=None):
+        """
+        wait until count transfers are done, or until none of the worker
+        threads is left; the request a hedged one beat may still hang in a
+        read, it is left behind
+        """
+        with self.lock:
+            while self.completed < count:
+                if workers is not None and \
+                        not any(worker.is_alive() for worker in workers):
+                    break
+                self.changed.wait(1)
+
+    def hedge(self, transfer, url):
+        """
+        one more request for a straggling transfer, maybe to another host
+        """
+        self.write_log('%s: hedged by %s' % (transfer.url, url))
+        if self.tracer is not None:
+            self.tracer.instant('hedge', 'transfer', {'url': transfer.url,
+                                                      'hedge': url})
+        try:
+            self._fetch(transfer, url, primary=False)
+        except Cancelled:
+            pass
+        except Exception as e:
+            # IncompleteRead, BadStatusLine, a bad header...: the primary
+            # request goes on
+            transfer.hedge_error = '%s: %s' % (type(e).__name__, e)
+            self.write_log('%s: hedge failed: %s'
+                           % (url, transfer.hedge_error))
+
+    def hedge_stragglers(self, ratio, after, alternates=None):
+        """
+        hedge the transfers running for more than after seconds at less
+        than ratio times the median throughput of the stage
+        """
+        now = time.time()
+        with self.lock:
+            rates = self.rates + [transfer.throughput()
+                                  for transfer in self.active.values()]
+            if len(rates) < 3:
+                return
+            median = sorted(rates)[len(rates) // 2]
+            stragglers = [transfer for transfer in self.active.values()
+                          if transfer.hedged is None and not transfer.done and
+                          now - transfer.started >= after and
+                          transfer.throughput() < median * ratio]
+            for transfer in stragglers:
+                url = transfer.url
+                host = url_host(url)
+                if alternates and host in alternates:
+                    url = url.replace('://' + host, '://' + alternates[host], 1)
+                transfer.hedged = threading.Thread(target=self.hedge,
+                                                   args=(transfer, url))
+                transfer.hedged.daemon = True
+                transfer.hedged.start()
+
+    def _fetch(self, transfer, url, primary=True):
+        path = transfer.path
+        size = transfer.size
+        checksum = transfer.checksum
+        host = url_host(transfer.url)
+        headers = {}
+        digest = None
+        if checksum:
+            digest = hashlib.new(checksum[0])
+        if not transfer.immutable and os.path.exists(path):
+            # revalidate, like wget -N
+            headers['If-Modified-Since'] = email.utils.formatdate(
+                os.path.getmtime(path), usegmt=True)
+        try:
+            response = self.opener.open(self.request(url, headers),
+                                        timeout=TIMEOUT)
+            if transfer.first_byte is None:
+                transfer.first_byte = time.time()
+        except HTTPError as e:
+            if e.code == 304:
+                self.write_log('%s: not modified' % url)
+                transfer.first_byte = transfer.first_byte or time.time()
+                transfer.not_modified = True
+                if self.finish(transfer, None, 0, primary):
+                    self.done(host, size - transfer.received)
+                return True
+            raise
+
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        tmp_path = path + ('.apt-mirror-tmp' if primary else '.apt-mirror-hedge')
+        received = 0
+        # whatever has arrived, so that slow transfers are measured and
+        # cancelled between chunks
+        read = getattr(response, 'read1', response.read)
+        try:
+            with self.open_tmp(tmp_path) as fp:
+                if transfer.immutable:
+                    preallocate(fp, size)
+                while 1:
+                    chunk = read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if self.limiter is not None:
+                        self.limiter.consume(host, len(chunk))
+                    fp.write(chunk)
+                    if digest is not None:
+                        digest.update(chunk)
+                    received += len(chunk)
+                    if primary:
+                        with transfer.lock:
+                            if transfer.done:
+                                raise Cancelled()
+                            transfer.received = received
+                            if self.progress is not None:
+                                self.progress.add_bytes(self.stage, host,
+                                                        len(chunk))
+                    elif transfer.done:
+                        raise Cancelled()
+            if transfer.immutable and size and received != size:
+                raise FetchError('got %d of %d bytes' % (received, size))
+            if digest is not None and digest.hexdigest() != checksum[1]:
+                raise FetchError('%s mismatch' % checksum[0])
+        except Exception as e:
+            if primary and not isinstance(e, Cancelled):
+                with transfer.lock:
+                    transfer.received = 0
+                    if self.progress is not None:
+                        self.progress.add_bytes(self.stage, host, -received)
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        finally:
+            response.close()
+
+        set_mtime(tmp_path, response)
+        if not self.finish(transfer, tmp_path, received, primary):
+            os.unlink(tmp_path)
+            raise Cancelled()
+        self.write_log('%s: %d bytes' % (url, received))
+        if self.progress is not None:
+            self.progress.file_done(self.stage, host)
+        return True
+
+    def segmented(self, transfer):
+        return (self.segments > 1 and self.segment_threshold and
+                transfer.immutable and
+                transfer.size >= self.segment_threshold and
+                transfer.url.split('://')[0] in ('http', 'https'))
+
+    def _fetch_segments(self, transfer, url):
+        """
+        download a large file as parallel Range requests into a file of the
+        final size, then check its size and hash
+        """
+        path = transfer.path
+        size = transfer.size
+        host = url_host(transfer.url)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        tmp_path = path + '.apt-mirror-tmp'
+
+        segment_size = -(-size // self.segments)
+        ranges = [(start, min(start + segment_size, size) - 1)
+                  for start in range(0, size, segment_size)]
+        errors = []
+        responses = []
+
+        def fetch_segment(start, end):
+            try:
+                response = self.opener.open(
+                    self.request(url, {'Range': 'bytes=%d-%d' % (start, end)}),
+                    timeout=TIMEOUT)
+            except Exception as e:
+                errors.append(e)
+                return
+            responses.append(response)
+            if transfer.first_byte is None:
+                transfer.first_byte = time.time()
+            try:
+                if response.getcode() != 206:
+                    raise NoRange()
+                read = getattr(response, 'read1', response.read)
+                with open(tmp_path, 'r+b') as fp:
+                    fp.seek(start)
+                    remaining = end + 1 - start
+                    while remaining > 0:
+                        chunk = read(min(CHUNK_SIZE, remaining))
+                        if not chunk:
+                            raise FetchError('segment %d-%d is short'
+                                             % (start, end))
+                        if self.limiter is not None:
+                            self.limiter.consume(host, len(chunk))
+                        fp.write(chunk)
+                        remaining -= len(chunk)
+                        with transfer.lock:
+                            if transfer.done:
+                                raise Cancelled()
+                            transfer.received += len(chunk)
+                            if self.progress is not None:
+                                self.progress.add_bytes(self.stage, host,
+                                                        len(chunk))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                response.close()
+
+        # the segments write through files of their own, the write back
+        # covers them all
+        with self.open_tmp(tmp_path) as fp:
+            preallocate(fp, size)
+            threads = [threading.Thread(target=fetch_segment, args=segment)
+                       for segment in ranges]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        received = transfer.received
+        try:
+            for error in errors:
+                # the real failure rather than a segment that was cancelled
+                if isinstance(error, (NoRange, FetchError, HTTPError)):
+                    raise error
+                if not isinstance(error, Cancelled):
+                    # IncompleteRead, BadStatusLine...: retried by fetch()
+                    raise FetchError('segment failed: %s: %s'
+                                     % (type(error).__name__, error))
+            if errors:
+                raise errors[0]
+            if os.path.getsize(tmp_path) != size:
+                raise FetchError('got %d of %d bytes'
+                                 % (os.path.getsize(tmp_path), size))
+            if transfer.checksum and \
+                    hash_file((tmp_path, transfer.checksum[0]))[1] != \
+                    transfer.checksum[1]:
+                raise FetchError('%s mismatch' % transfer.checksum[0])
+        except Exception as e:
+            if not isinstance(e, Cancelled):
+                with transfer.lock:
+                    transfer.received = 0
+                    if self.progress is not None:
+                        self.progress.add_bytes(self.stage, host, -received)
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        set_mtime(tmp_path, responses[0])
+        if not self.finish(transfer, tmp_path, received, True):
+            os.unlink(tmp_path)
+            raise Cancelled()
+        self.write_log('%s: %d bytes in %d segments'
+                       % (url, received, len(ranges)))
+        if self.progress is not None:
+            self.progress.file_done(self.stage, host)
+        return True
+
+    def finish(self, transfer, tmp_path, received, primary):
+        """
+        put tmp_path in place unless the other request did it first
+        """
+        with transfer.lock:
+            if transfer.done:
+                return False
+            transfer.done = True
+            if tmp_path is not None:
+                if self.writer is not None:
+                    self.writer.place(tmp_path, transfer.path)
+                else:
+                    os.rename(tmp_path, transfer.path)
+            if not primary and self.progress is not None and tmp_path:
+                # progress has seen the bytes of the first request only
+                self.progress.add_bytes(self.stage, url_host(transfer.url),
+                                        received - transfer.received)
+        self.complete()
+        return True
+
+    def done(self, host, size):
+        if self.progress is not None:
+            self.progress.add_bytes(self.stage, host, size)
+            self.progress.file_done(self.stage, host)
+
+
+def set_mtime(path, response):
+    last_modified = response.info().get('Last-Modified')
+    if last_modified:
+        parsed = email.utils.parsedate(last_modified)
+        if parsed:
+            mtime = calendar.timegm(parsed)
+            os.utime(path, (mtime, mtime))
+
+
+def fetch_worker(fetcher, target_dir, task_queue, immutable=False):
+    while 1:
+        item = task_queue.get()
+        if item is None:
+            break
+        url, size, checksum = item
+        try:
+            fetcher.fetch(url, target_dir, size, immutable, checksum)
+        except Exception as e:
+            # keep the worker for the rest of the queue
+            logging.warning('apt-mirror: failed to download %s: %s'
+                            % (url, e))
+
+
+def hedge_monitor(fetcher, task_queue, nthreads, stopped, ratio, after,
+                  alternates):
+    """
+    hedge stragglers once every url of the stage has been started, only the
+    worker stop markers are left in the queue then
+    """
+    while not stopped.wait(1):
+        if task_queue.qsize() <= nthreads:
+            fetcher.hedge_stragglers(ratio, after, alternates)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python2
+# coding:utf-8
+
+import fnmatch
+import re
+
+
+class PackageFilter(object):
+    """
+    include/exclude rules of a mirror or suite
+
+    A package is kept if it matches one of the include rules (or there
+    are none) and none of the exclude rules.
+    """
+
+    def __init__(self, rules):
+        self.includes = []
+        self.excludes = []
+        for rule_type, field, pattern in rules:
+            rule = (field, self.compile(field, pattern))
+            if rule_type == 'include':
+                self.includes.append(rule)
+            else:
+                self.excludes.append(rule)
+        return
+
+    @staticmethod
+    def compile(field, pattern):
+        if field == 'regex':
+            return re.compile(pattern)
+        return re.compile(fnmatch.translate(pattern))
+
+    @staticmethod
+    def match_rule(rule, entry):
+        field, pattern = rule
+        if field in ('name', 'regex'):
+            value = entry.get('Package')
+        else:
+            value = entry.get(field.capitalize())
+        if not value:
+            return False
+        if field == 'regex':
+            return pattern.search(value) is not None
+        if field == 'section':
+            # "universe/games" matches both "universe/games" and "games"
+            return pattern.match(value) is not None or \
+                pattern.match(value.rsplit('/', 1)[-1]) is not None
+        return pattern.match(value) is not None
+
+    def match(self, entry):
+        if self.includes and \
+                not any(self.match_rule(r, entry) for r in self.includes):
+            return False
+        return not any(self.match_rule(r, entry) for r in self.excludes)
+
+
+def get_package_filter(config, suite):
+    """
+    the filter for a suite, None if no rules apply to it
+    """
+    base_url = suite.mirror.url.rstrip('/')
+    rules = []
+    for url, suite_name, rule_type, field, pattern in config.package_filters:
+        if url == base_url and suite_name in (None, suite.suite):
+            rules.append((rule_type, field, pattern))
+    if not rules:
+        return None
+    return PackageFilter(rules)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python2
+# coding:utf-8
+"""
+Binary cache of parsed Packages/Sources indexes.
+
+A cache file is keyed by the SHA256 of the index file as listed in Release,
+so an unchanged index is loaded without decompressing or parsing it again.
+
+File layout:
+    MAGIC
+    header length (uint32, little endian)
+    json header: {"count": n, "columns": [[name, kind, offset, length], ...],
+                  "raw_size": size of the uncompressed index, ...}
+    column data
+
+Column kinds:
+    s   NUL separated strings
+    i   unsigned 64 bit integers, little endian
+    hN  raw digests of N bytes, all zeros for a missing value
+"""
+
+import array
+import binascii
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+
+MAGIC = b'APTMIDX\x01'
+
+# the columns of a cached index, in file order
+COLUMNS = [
+    ('Filename', 's'),
+    ('Size', 'i'),
+    ('MD5sum', 'h16'),
+    ('SHA1', 'h20'),
+    ('SHA256', 'h32'),
+    ('Package', 's'),
+    ('Section', 's'),
+    ('Priority', 's'),
+    ('Source', 's'),
+    ('Depends', 's'),
+    ('Pre-Depends', 's'),
+    ('Recommends', 's'),
+    ('Provides', 's'),
+    ('Version', 's'),
+    ('Architecture', 's'),
+]
+
+
+def _int_array(values=()):
+    for code in ('L', 'Q'):
+        try:
+            if array.array(code).itemsize == 8:
+                return array.array(code, values)
+        except ValueError:
+            continue
+    raise Exception('apt-mirror: no 64 bit array type on this platform')
+
+
+def _to_bytes(string):
+    if isinstance(string, bytes):
+        return string
+    return string.encode('utf-8')
+
+
+def _to_str(data):
+    if isinstance(data, str):
+        return data
+    return data.decode('utf-8')
+
+
+class ParsedIndex(object):
+    """
+    column store of the files listed in one index
+    """
+
+    def __init__(self, header, columns):
+        self.header = header
+        self.columns = columns
+        self.count = header['count']
+        return
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return self.entries()
+
+    def filenames(self):
+        return self.columns['Filename']
+
+    def sizes(self):
+        return self.columns['Size']
+
+    def digest(self, name, i):
+        width, data = self.columns[name]
+        value = data[i * width:(i + 1) * width]
+        if value == b'\x00' * width:
+            return None
+        return _to_str(binascii.hexlify(value))
+
+    def entry(self, i):
+        entry = {}
+        for name, kind in COLUMNS:
+            if name not in self.columns:
+                continue
+            if kind[0] == 'h':
+                value = self.digest(name, i)
+                if value is None:
+                    continue
+            else:
+                value = self.columns[name][i]
+                if value == '':
+                    continue
+            entry[name] = value
+        return entry
+
+    def entries(self):
+        for i in range(self.count):
+            yield self.entry(i)
+
+    def find(self, filename):
+        try:
+            return self.entry(self.filenames().index(filename))
+        except ValueError:
+            return None
+
+
+class IndexCache(object):
+    """
+    directory of parsed index caches
+    """
+
+    def __init__(self, path, tilde=0):
+        self.path = path
+        self.tilde = tilde
+        self.used = set()
+        return
+
+    def cache_file(self, digest):
+        return os.path.join(self.path, digest + '.idx')
+
+    def load(self, digest):
+        self.used.add(digest)
+        try:
+            fp = open(self.cache_file(digest), 'rb')
+        except IOError:
+            return None
+        try:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            fp.close()
+            return None
+        try:
+            return self._decode(data)
+        except Exception:
+            logging.warning('apt-mirror: broken index cache %s' %
+                            self.cache_file(digest))
+            return None
+        finally:
+            data.close()
+            fp.close()
+
+    def _decode(self, data):
+        if data[:len(MAGIC)] != MAGIC:
+            return None
+        start = len(MAGIC) + 4
+        header_size, = struct.unpack('<I', data[len(MAGIC):start])
+        header = json.loads(_to_str(data[start:start + header_size]))
+        if header.get('tilde') != self.tilde:
+            return None
+        base = start + header_size
+        columns = {}
+        for name, kind, offset, length in header['columns']:
+            blob = data[base + offset:base + offset + length]
+            if kind == 's':
+                values = _to_str(blob).split('\0') if header['count'] else []
+            elif kind == 'i':
+                values = _int_array()
+                if hasattr(values, 'frombytes'):
+                    values.frombytes(blob)
+                else:
+                    values.fromstring(blob)
+                if sys.byteorder != 'little':
+                    values.byteswap()
+            else:
+                values = (int(kind[1:]), blob)
+            columns[name] = values
+        if set(name for name, _kind in COLUMNS) - set(columns):
+            # written by an older version
+            return None
+        return ParsedIndex(header, columns)
+
+    def save(self, digest, entries, raw_size=0):
+        self.used.add(digest)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        blobs = []
+        header_columns = []
+        offset = 0
+        for name, kind in COLUMNS:
+            if kind == 's':
+                blob = _to_bytes('\0'.join(e.get(name, '') for e in entries))
+            elif kind == 'i':
+                values = _int_array(int(e.get(name, 0)) for e in entries)
+                if sys.byteorder != 'little':
+                    values.byteswap()
+                blob = values.tobytes() if hasattr(values, 'tobytes') \
+                    else values.tostring()
+            else:
+                width = int(kind[1:])
+                blob = b''.join(binascii.unhexlify(e[name]) if e.get(name)
+                                else b'\x00' * width for e in entries)
+            header_columns.append([name, kind, offset, len(blob)])
+            blobs.append(blob)
+            offset += len(blob)
+        header = _to_bytes(json.dumps({'count': len(entries),
+                                       'columns': header_columns,
+                                       'raw_size': raw_size,
+                                       'tilde': self.tilde}))
+
+        filename = self.cache_file(digest)
+        tmp_file = filename + '.tmp'
+        with open(tmp_file, 'wb') as fp:
+            fp.write(MAGIC)
+            fp.write(struct.pack('<I', len(header)))
+            fp.write(header)
+            for blob in blobs:
+                fp.write(blob)
+        os.rename(tmp_file, filename)
+
+    def prune(self):
+        # remove caches of indexes that were not used in this run
+        if not os.path.isdir(self.path):
+            return
+        for fn in os.listdir(self.path):
+            if fn.rsplit('.', 1)[0] not in self.used:
+                os.unlink(os.path.join(self.path, fn))
+
+
+def suite_indexes(cache, suite):
+    """
+    yield (index_path, ParsedIndex) for the cached indexes of a suite
+    """
+    if not suite.sources and not suite.packages:
+        suite.get_indexes()
+    for index_path in suite.sources + suite.packages:
+        _local_file, digest = suite.index_checksum(index_path)
+        if digest:
+            parsed = cache.load(digest)
+            if parsed is not None:
+                yield index_path, parsed
+
+
+def suite_files(cache, suite):
+    """
+    the pool files that belong to a suite, according to the cache
+    """
+    files = set()
+    for _index_path, parsed in suite_indexes(cache, suite):
+        files.update(parsed.filenames())
+    return sorted(files)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python2
+# coding:utf-8
+"""
+Keep a sync from hurting the clients served from the same disks.
+
+io_priority and cpu_nice lower the priority of apt-mirror; threads and
+child processes (wget, rsync, shard workers) inherit it. IOThrottle caps
+the downloaded files written back to disk at once and holds downloads
+back while the disk of mirror_path answers slower than disk_latency ms
+per request, as measured from /proc/diskstats.
+"""
+
+import ctypes
+import logging
+import os
+import platform
+import subprocess
+import threading
+import time
+
+IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+# ioprio_set syscall numbers, there is no libc wrapper
+SYS_IOPRIO_SET = {'x86_64': 251, 'i386': 289, 'i686': 289,
+                  'aarch64': 30, 'armv7l': 314, 'ppc64le': 273,
+                  's390x': 282}
+# the longest a writer waits for the disk to calm down, a sync must
+# still make progress on a busy host
+MAX_BACKOFF = 10.0
+# SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE | WAIT_AFTER
+SYNC_FILE_RANGE_ALL = 7
+
+
+def parse_io_priority(value):
+    """
+    "idle" or "best-effort:7" -> (class, level)
+    """
+    name, _sep, level = value.strip().partition(':')
+    if name not in IOPRIO_CLASSES:
+        raise Exception('apt-mirror: invalid io_priority "%s"' % value)
+    return IOPRIO_CLASSES[name], int(level or 4)
+
+
+def set_io_priority(value):
+    """
+    set the I/O scheduling class of the calling thread, which threads and
+    processes started later inherit; returns True on success
+    """
+    io_class, level = parse_io_priority(value)
+    number = SYS_IOPRIO_SET.get(platform.machine())
+    if number is not None:
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            if libc.syscall(number, IOPRIO_WHO_PROCESS, 0,
+                            (io_class << IOPRIO_CLASS_SHIFT) | level) == 0:
+                return True
+        except (OSError, AttributeError):
+            pass
+    # ionice(1) does the same
+    args = ['ionice', '-c', str(io_class)]
+    if io_class != IOPRIO_CLASSES['idle']:
+        args += ['-n', str(level)]
+    try:
+        return subprocess.call(args + ['-p', str(os.getpid())]) == 0
+    except OSError:
+        return False
+
+
+def lower_priority(io_priority='', nice=0):
+    # once per process, os.nice() adds up
+    if io_priority and not set_io_priority(io_priority):
+        logging.warning("apt-mirror: can't set io_priority %s" % io_priority)
+    if nice > 0:
+        os.nice(nice)
+
+
+def sync_file_range(fd):
+    """
+    write the data of fd to disk and wait for it, without the metadata and
+    cache flush of fdatasync() where sync_file_range(2) is there
+    """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.sync_file_range(fd, ctypes.c_longlong(0),
+                                ctypes.c_longlong(0),
+                                SYNC_FILE_RANGE_ALL) == 0:
+            return
+    except (OSError, AttributeError):
+        pass
+    os.fdatasync(fd)
+
+
+def find_device(path):
+    """
+    the /proc/diskstats name of the block device path is on, None if it
+    has none (tmpfs, NFS, btrfs subvolumes)
+    """
+    while not os.path.exists(path) and path not in ('', '/'):
+        path = os.path.dirname(path)
+    dev = os.stat(path).st_dev
+    major, minor = os.major(dev), os.minor(dev)
+    try:
+        with open('/proc/diskstats') as fp:
+            for line in fp:
+                fields = line.split()
+                if len(fields) > 10 and \
+                        (int(fields[0]), int(fields[1])) == (major, minor):
+                    return fields[2]
+    except IOError:
+        pass
+    return None
+
+
+def read_diskstats(device):
+    """
+    (requests completed, ms spent on them) of device
+    """
+    with open('/proc/diskstats') as fp:
+        for line in fp:
+            fields = line.split()
+            if len(fields) > 10 and fields[2] == device:
+                # reads completed, ms reading, writes completed, ms writing
+                return (int(fields[3]) + int(fields[7]),
+                        int(fields[6]) + int(fields[10]))
+    return None
+
+
+class IOThrottle(object):
+    """
+    at most writers files written back at once (0: no cap), downloads held
+    back while the disk is slower than latency ms per request (0: off)
+    """
+
+    def __init__(self, writers=0, latency=0, path='/', interval=1.0):
+        self.slots = threading.BoundedSemaphore(writers) if writers else None
+        self.limit = latency
+        self.interval = interval
+        # average ms per request during the last interval
+        self.latency = 0.0
+        self.device = None
+        if latency:
+            self.device = find_device(path)
+            if self.device is None:
+                logging.warning('apt-mirror: no disk statistics for %s, '
+                                'disk_latency is ignored' % path)
+        if self.device is not None:
+            monitor = threading.Thread(target=self._monitor)
+            monitor.daemon = True
+            monitor.start()
+        return
+
+    def _monitor(self):
+        last = read_diskstats(self.device)
+        while last is not None:
+            time.sleep(self.interval)
+            current = read_diskstats(self.device)
+            if current is None:
+                break
+            requests = current[0] - last[0]
+            self.latency = float(current[1] - last[1]) / requests \
+                if requests > 0 else 0.0
+            last = current
+
+    def backoff(self):
+        # exponential, up to MAX_BACKOFF seconds in all
+        delay = 0.05
+        waited = 0.0
+        while self.device is not None and self.latency > self.limit and \
+                waited < MAX_BACKOFF:
+            time.sleep(delay)
+            waited += delay
+            delay = min(delay * 2, 1.0)
+
+    def write_back(self, fp):
+        """
+        flush a downloaded file and wait for its data to reach the disk, in
+        one of the writer slots; the transfer itself holds none
+        """
+        if self.slots is None:
+            return
+        fp.flush()
+        with self.slots:
+            sync_file_range(fp.fileno())
+
+
+def create_throttle(config):
+    if not config.disk_writers and not config.disk_latency:
+        return None
+    if config.disk_writers and config.downloader != 'native':
+        # wget and rsync write on their own
+        logging.warning('apt-mirror: disk_writers needs downloader native, '
+                        'it is ignored')
+    return IOThrottle(writers=config.disk_writers,
+                      latency=config.disk_latency,
+                      path=config.mirror_path)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python2
+# coding:utf-8
+"""
+The keep set of "set clean_method merge": the store paths apt-mirror
+needs, in sorted runs on disk instead of the skipclean dict.
+
+Paths are compared by a key with "/" replaced by NUL. That is the order
+of a depth first walk which visits the entries of every directory sorted
+by name, so clean can walk the mirror and the merged runs side by side,
+a merge join whose memory does not grow with the number of files.
+
+A run file holds NUL terminated paths, like the removal manifest; any
+other byte may be part of a path. The run directory of a KeepSet is
+locked while it is in use, one left behind by an aborted apt-mirror is
+removed by the next apt-mirror using the same tmp_dir.
+"""
+
+import fcntl
+import heapq
+import os
+import shutil
+import tempfile
+import threading
+
+# keys kept in memory before they are sorted into a run file
+RUN_SIZE = 100000
+
+
+def sort_key(path):
+    return path.replace('/', '\0')
+
+
+def _encode(key):
+    # the path of key, NUL terminated
+    record = key.replace('\0', '/') + '\0'
+    if not isinstance(record, bytes):
+        record = record.encode('utf-8', 'surrogateescape')
+    return record
+
+
+def _read_keys(fp, block_size=1 << 16):
+    rest = b''
+    for block in iter(lambda: fp.read(block_size), b''):
+        records = (rest + block).split(b'\0')
+        rest = records.pop()
+        for record in records:
+            if not isinstance(record, str):
+                record = record.decode('utf-8', 'surrogateescape')
+            yield sort_key(record)
+
+
+def remove_stale_runs(tmp_dir):
+    """
+    remove the run directories no KeepSet holds a lock on
+    """
+    if not os.path.isdir(tmp_dir):
+        return
+    for name in os.listdir(tmp_dir):
+        run_dir = os.path.join(tmp_dir, name)
+        if not name.startswith('keep.') or \
+                not os.path.isfile(os.path.join(run_dir, 'lock')):
+            continue
+        try:
+            lock_file = open(os.path.join(run_dir, 'lock'), 'a')
+        except IOError:
+            continue
+        try:
+            fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            # in use by another apt-mirror
+            lock_file.close()
+            continue
+        shutil.rmtree(run_dir, ignore_errors=True)
+        lock_file.close()
+
+
+class KeepSet(object):
+    """
+    write-only stand-in for config.skipclean, read back in sorted order
+    """
+
+    def __init__(self, tmp_dir, run_size=RUN_SIZE):
+        self.tmp_dir = tmp_dir
+        self.run_size = run_size
+        self.run_dir = None
+        self.lock_file = None
+        self.runs = []
+        self.buffer = set()
+        self.lock = threading.Lock()
+        remove_stale_runs(tmp_dir)
+        return
+
+    def __setitem__(self, path, value):
+        # skipclean[path] = 1, from the metadata threads too
+        with self.lock:
+            self.buffer.add(sort_key(path))
+            if len(self.buffer) >= self.run_size:
+                self.spill()
+
+    def spill(self):
+        if self.run_dir is None:
+            if not os.path.isdir(self.tmp_dir):
+                os.makedirs(self.tmp_dir)
+            # apt-mirrors of other mirrors may share var_path
+            self.run_dir = tempfile.mkdtemp(prefix='keep.', dir=self.tmp_dir)
+            self.lock_file = open(os.path.join(self.run_dir, 'lock'), 'a')
+            fcntl.lockf(self.lock_file, fcntl.LOCK_EX)
+        run_file = os.path.join(self.run_dir, '%06d' % len(self.runs))
+        with open(run_file, 'wb') as fp:
+            for key in sorted(self.buffer):
+                fp.write(_encode(key))
+        self.runs.append(run_file)
+        self.buffer = set()
+
+    def keys(self):
+        """
+        all keys in order, without duplicates
+        """
+        files = [open(run_file, 'rb') for run_file in self.runs]
+        try:
+            streams = [_read_keys(fp) for fp in files]
+            streams.append(iter(sorted(self.buffer)))
+            last = None
+            for key in heapq.merge(*streams):
+                if key != last:
+                    yield key
+                    last = key
+        finally:
+            for fp in files:
+                fp.close()
+
+    def cursor(self):
+        return KeepCursor(self.keys())
+
+    def close(self):
+        if self.run_dir is not None:
+            shutil.rmtree(self.run_dir, ignore_errors=True)
+            self.lock_file.close()
+            self.run_dir = None
+            self.lock_file = None
+        self.runs = []
+        self.buffer = set()
+
+
+class KeepCursor(object):
+    """
+    move forwards through the sorted keys of a KeepSet
+    """
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.current = next(self.keys, None)
+        return
+
+    def seek(self, key):
+        """
+        whether key is in the set; smaller keys are skipped for good
+        """
+        while self.current is not None and self.current < key:
+            self.current = next(self.keys, None)
+        return self.current == key
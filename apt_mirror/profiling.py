@@ -0,0 +1,116 @@
+#!/usr/bin/env python2
+# coding:utf-8
+"""
+Per-phase profiles of a run (apt-mirror --profile).
+
+Every phase of AptMirror.run is run under cProfile and, where available,
+tracemalloc. The reports are written to one directory per run:
+    NN-PHASE.pstats   raw cProfile data, for pstats or snakeviz
+    NN-PHASE.txt      functions sorted by cumulative and own time, top
+                      allocation sites and peak memory
+    summary.txt       wall time and peak memory of every phase
+
+The thread that runs the phase and every thread started during it (task
+graph jobs, download workers) are profiled, each with a cProfile of its
+own merged into the phase report; wget/rsync children are not.
+"""
+
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+from .utils import format_bytes
+
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 25
+
+
+class PhaseProfiler(object):
+    """
+    profile phases one after another, reports go to profile_dir
+    """
+
+    def __init__(self, profile_dir):
+        self.profile_dir = os.path.join(profile_dir,
+                                        time.strftime('%Y%m%d-%H%M%S'))
+        self.phases = []
+        # profiles of the threads started during the current phase
+        self.thread_profiles = []
+        self.lock = threading.Lock()
+        return
+
+    def _profile_thread(self, frame, event, arg):
+        # first event of a new thread: profile the rest of it with a
+        # cProfile of its own
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+: the profile of the phase covers all threads
+            return
+        with self.lock:
+            self.thread_profiles.append(profile)
+
+    def run(self, name, func, *args, **kwargs):
+        if not os.path.isdir(self.profile_dir):
+            os.makedirs(self.profile_dir)
+        prefix = os.path.join(self.profile_dir,
+                              '%02d-%s' % (len(self.phases) + 1, name))
+        profile = cProfile.Profile()
+        if tracemalloc is not None:
+            # one frame per trace keeps the overhead low enough for a
+            # production run
+            tracemalloc.start(1)
+        self.thread_profiles = []
+        threading.setprofile(self._profile_thread)
+        started = time.time()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            elapsed = time.time() - started
+            threading.setprofile(None)
+            stats = pstats.Stats(profile)
+            with self.lock:
+                for thread_profile in self.thread_profiles:
+                    stats.add(thread_profile)
+                self.thread_profiles = []
+            snapshot = None
+            peak = None
+            if tracemalloc is not None:
+                snapshot = tracemalloc.take_snapshot()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            self.phases.append((name, elapsed, peak))
+            self.write_report(prefix, name, stats, elapsed, snapshot, peak)
+            self.write_summary()
+
+    def write_report(self, prefix, name, stats, elapsed, snapshot, peak):
+        stats.dump_stats(prefix + '.pstats')
+        with open(prefix + '.txt', 'w') as fp:
+            fp.write('phase %s: %.3f seconds\n' % (name, elapsed))
+            if peak is not None:
+                fp.write('peak traced memory: %s\n' % format_bytes(peak))
+            for sort_key in ('cumulative', 'tottime'):
+                fp.write('\n=== functions by %s time ===\n' % sort_key)
+                stats.stream = fp
+                stats.sort_stats(sort_key).print_stats(TOP_FUNCTIONS)
+            if snapshot is not None:
+                fp.write('\n=== top allocation sites ===\n')
+                for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+                    fp.write('%s\n' % stat)
+
+    def write_summary(self):
+        with open(os.path.join(self.profile_dir, 'summary.txt'), 'w') as fp:
+            for name, elapsed, peak in self.phases:
+                fp.write('%-12s %10.3f s  %s\n' % (
+                    name, elapsed,
+                    format_bytes(peak) if peak is not None else '-'))
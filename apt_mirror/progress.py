@@ -0,0 +1,310 @@
+#!/usr/bin/env python2
+# coding:utf-8
+
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+from .utils import format_bytes
+
+
+class Counter(object):
+    """
+    files and bytes planned and done
+    """
+
+    def __init__(self):
+        self.files_planned = 0
+        self.bytes_planned = 0
+        self.files_done = 0
+        self.bytes_done = 0
+        return
+
+    def as_dict(self):
+        return {'files_planned': self.files_planned,
+                'bytes_planned': self.bytes_planned,
+                'files_done': self.files_done,
+                'bytes_done': self.bytes_done}
+
+
+class StageProgress(Counter):
+
+    def __init__(self):
+        Counter.__init__(self)
+        self.hosts = {}
+        self.started = time.time()
+        self.finished = None
+        return
+
+    def host(self, host):
+        if host not in self.hosts:
+            self.hosts[host] = Counter()
+        return self.hosts[host]
+
+
+class Progress(object):
+    """
+    download progress of a run, fed by the byte counters of the download
+    path and reported to sinks every interval seconds
+    """
+
+    def __init__(self, sinks=(), interval=2, window=10):
+        self.sinks = list(sinks)
+        self.interval = interval
+        self.window = window
+        self.stages = {}
+        self.watchers = []
+        self.samples = []
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopped = threading.Event()
+        return
+
+    def _stage(self, stage):
+        if stage not in self.stages:
+            self.stages[stage] = StageProgress()
+        return self.stages[stage]
+
+    def plan(self, stage, host, size=0):
+        with self.lock:
+            for counter in (self._stage(stage), self._stage(stage).host(host)):
+                counter.files_planned += 1
+                counter.bytes_planned += size
+
+    def add_bytes(self, stage, host, size):
+        with self.lock:
+            self._stage(stage).bytes_done += size
+            self._stage(stage).host(host).bytes_done += size
+
+    def file_done(self, stage, host):
+        with self.lock:
+            self._stage(stage).files_done += 1
+            self._stage(stage).host(host).files_done += 1
+
+    def finish(self, stage):
+        with self.lock:
+            self._stage(stage).finished = time.time()
+        self.emit('stage_end', stage)
+
+    def watch(self, watcher):
+        with self.lock:
+            self.watchers.append(watcher)
+
+    def unwatch(self, watcher):
+        watcher.poll()
+        with self.lock:
+            self.watchers.remove(watcher)
+
+    def throughput(self):
+        # bytes per second over the sliding window
+        now = time.time()
+        with self.lock:
+            total = sum(s.bytes_done for s in self.stages.values())
+            self.samples.append((now, total))
+            while self.samples and self.samples[0][0] < now - self.window:
+                self.samples.pop(0)
+            first_time, first_total = self.samples[0]
+        if now - first_time < 0.5:
+            return 0.0
+        return (total - first_total) / (now - first_time)
+
+    def snapshot(self):
+        throughput = self.throughput()
+        with self.lock:
+            stages = {}
+            remaining = 0
+            for name, stage in self.stages.items():
+                data = stage.as_dict()
+                data['finished'] = stage.finished is not None
+                data['hosts'] = dict((host, counter.as_dict())
+                                     for host, counter in stage.hosts.items())
+                stages[name] = data
+                if stage.finished is None:
+                    remaining += max(0, stage.bytes_planned - stage.bytes_done)
+        eta = None
+        if throughput > 0:
+            eta = int(remaining / throughput)
+        return {'time': time.time(),
+                'stages': stages,
+                'throughput': int(throughput),
+                'eta': eta}
+
+    def emit(self, event, stage=None):
+        data = self.snapshot()
+        data['event'] = event
+        if stage is not None:
+            data['stage'] = stage
+        for sink in list(self.sinks):
+            try:
+                sink.write(data)
+            except EnvironmentError:
+                # a dashboard going away must not stop the mirror
+                self.sinks.remove(sink)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                watchers = list(self.watchers)
+            for watcher in watchers:
+                watcher.poll()
+            self.emit('progress')
+
+    def start(self):
+        if self.thread is None and self.sinks:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+        self.emit('end')
+        for sink in self.sinks:
+            sink.close()
+
+
+class BatchWatcher(object):
+    """
+    follow a batch downloader (wget -i, rsync --files-from) which fetches
+    its files one after another: only the file at the cursor and a few
+    after it are stat()ed at each poll
+    """
+    LOOKAHEAD = 8
+
+    def __init__(self, progress, stage, files, child=None):
+        # files: [(local path, size, host)] in download order
+        self.progress = progress
+        self.stage = stage
+        self.files = files
+        self.child = child
+        self.cursor = 0
+        self.partial = 0
+        # sizes of stale copies when the file came into sight
+        self.baseline = {}
+        self.lock = threading.Lock()
+        return
+
+    def _size(self, i):
+        try:
+            return os.path.getsize(self.files[i][0])
+        except OSError:
+            return -1
+
+    def _advance(self, end):
+        for path, size, host in self.files[self.cursor:end]:
+            self.progress.add_bytes(self.stage, host, size - self.partial)
+            self.progress.file_done(self.stage, host)
+            self.partial = 0
+        self.cursor = max(self.cursor, end)
+
+    def poll(self):
+        with self.lock:
+            self._poll()
+
+    def _poll(self):
+        if self.cursor >= len(self.files):
+            return
+        if self.child is not None and self.child.poll() is not None:
+            self._advance(len(self.files))
+            return
+        # the downloader is at the last file that has started
+        end = min(len(self.files), self.cursor + self.LOOKAHEAD)
+        current = self.cursor
+        for i in range(self.cursor, end):
+            size = self._size(i)
+            if size == self.files[i][1]:
+                current = i + 1
+            elif size != self.baseline.setdefault(i, size) and i > current:
+                current = i
+        for i in range(self.cursor, current):
+            self.baseline.pop(i, None)
+        self._advance(current)
+        if self.cursor < len(self.files):
+            _path, size, host = self.files[self.cursor]
+            partial = min(max(0, self._size(self.cursor)), size)
+            if partial > self.partial:
+                self.progress.add_bytes(self.stage, host, partial - self.partial)
+                self.partial = partial
+
+
+class TTYSink(object):
+    """
+    one progress line, rewritten in place
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stderr
+        return
+
+    def write(self, data):
+        if data['event'] == 'end':
+            self.stream.write('\n')
+            self.stream.flush()
+            return
+        parts = []
+        for name in sorted(data['stages']):
+            stage = data['stages'][name]
+            if stage['finished']:
+                continue
+            parts.append('%s %d/%d files %s/%s' % (
+                name, stage['files_done'], stage['files_planned'],
+                format_bytes(stage['bytes_done']),
+                format_bytes(stage['bytes_planned'])))
+        line = ', '.join(parts) or 'idle'
+        line += ' | %s/s' % format_bytes(data['throughput'])
+        if data['eta'] is not None:
+            line += ' | ETA %d:%02d' % (data['eta'] // 60, data['eta'] % 60)
+        self.stream.write('\r\x1b[K' + line)
+        self.stream.flush()
+
+    def close(self):
+        return
+
+
+class JSONLinesSink(object):
+    """
+    one JSON object per line, to a file or to a unix socket ("unix:PATH")
+    """
+
+    def __init__(self, target):
+        self.sock = None
+        self.fp = None
+        if target.startswith('unix:'):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(target[len('unix:'):])
+        else:
+            self.fp = open(target, 'a')
+        return
+
+    def write(self, data):
+        line = json.dumps(data, sort_keys=True) + '\n'
+        if self.sock is not None:
+            self.sock.sendall(line.encode('utf-8'))
+        else:
+            self.fp.write(line)
+            self.fp.flush()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        if self.fp is not None:
+            self.fp.close()
+
+
+def create_progress(config):
+    sinks = []
+    if config.progress == 'tty' or \
+            (config.progress == 'auto' and sys.stderr.isatty()):
+        sinks.append(TTYSink())
+    if config.progress_events:
+        try:
+            sinks.append(JSONLinesSink(config.progress_events))
+        except EnvironmentError as e:
+            sys.stderr.write("apt-mirror: can't open progress events %s: %s\n"
+                             % (config.progress_events, e))
+    return Progress(sinks, interval=float(config.progress_interval))
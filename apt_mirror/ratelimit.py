@@ -0,0 +1,152 @@
+#!/usr/bin/env python2
+# coding:utf-8
+
+import logging
+import re
+import threading
+import time
+
+RATE_PATTERN = re.compile(r'^(?P<number>[\d.]+)(?P<unit>[kmg]?)(?P<bit>bit)?$',
+                          re.I)
+SCHEDULE_PATTERN = re.compile(
+    r'^(?P<start>\d\d?):(?P<start_min>\d\d)-(?P<end>\d\d?):(?P<end_min>\d\d)'
+    r'=(?P<rate>\S+)$')
+
+
+def parse_rate(value):
+    """
+    bytes per second from a rate like wget's --limit-rate: "100m" is 100
+    MiB/s; with a "bit" suffix units are decimal bits: "200mbit" is
+    200 Mbit/s. 0 or an empty value means no limit.
+    """
+    value = str(value).strip()
+    if not value:
+        return 0
+    match = RATE_PATTERN.match(value)
+    if not match:
+        raise Exception('apt-mirror: invalid rate "%s"' % value)
+    number = float(match.group('number'))
+    power = ' kmg'.index(match.group('unit').lower() or ' ')
+    if match.group('bit'):
+        return number * 1000 ** power / 8
+    return number * 1024 ** power
+
+
+def parse_schedule(value):
+    """
+    "08:00-18:00=200mbit 18:00-08:00=0" -> [(480, 1080, rate), ...]
+    """
+    schedule = []
+    for item in value.split():
+        match = SCHEDULE_PATTERN.match(item)
+        if not match:
+            raise Exception('apt-mirror: invalid rate schedule "%s"' % item)
+        start = int(match.group('start')) * 60 + int(match.group('start_min'))
+        end = int(match.group('end')) * 60 + int(match.group('end_min'))
+        schedule.append((start, end, parse_rate(match.group('rate'))))
+    return schedule
+
+
+def parse_host_rates(value):
+    """
+    "archive.ubuntu.com=50m security.ubuntu.com=20m" -> {host: rate}
+    """
+    rates = {}
+    for item in value.split():
+        host, rate = item.split('=', 1)
+        rates[host] = parse_rate(rate)
+    return rates
+
+
+class TokenBucket(object):
+    """
+    rate bytes per second with bursts up to one second of traffic
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.time()
+        self.lock = threading.Lock()
+        return
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.tokens = min(self.tokens, rate)
+
+    def reserve(self, size):
+        """
+        take size tokens, return how long the caller has to wait for them
+        """
+        with self.lock:
+            if not self.rate:
+                return 0
+            now = time.time()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= size
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+
+class BandwidthLimiter(object):
+    """
+    one token bucket shared by every download of a run, and one per host
+    """
+
+    def __init__(self, rate=0, host_rates=None, schedule=None):
+        self.default_rate = rate
+        self.schedule = schedule or []
+        self.bucket = TokenBucket(self.scheduled_rate())
+        self.host_buckets = {}
+        for host, host_rate in (host_rates or {}).items():
+            self.host_buckets[host] = TokenBucket(host_rate)
+        self.checked = time.time()
+        return
+
+    def scheduled_rate(self, now=None):
+        local = time.localtime(now)
+        minute = local.tm_hour * 60 + local.tm_min
+        for start, end, rate in self.schedule:
+            if start <= end and start <= minute < end:
+                return rate
+            if start > end and (minute >= start or minute < end):
+                # window over midnight
+                return rate
+        return self.default_rate
+
+    def consume(self, host, size):
+        now = time.time()
+        if self.schedule and now - self.checked >= 1:
+            self.checked = now
+            self.bucket.set_rate(self.scheduled_rate(now))
+        delay = self.bucket.reserve(size)
+        if host in self.host_buckets:
+            delay = max(delay, self.host_buckets[host].reserve(size))
+        if delay > 0:
+            time.sleep(delay)
+
+
+def child_rates(value, children):
+    """
+    (wget --limit-rate, rsync --bwlimit) of one of children processes
+    sharing the rate value; wget takes bytes, rsync KiB per second
+    """
+    rate = parse_rate(value)
+    if not rate:
+        return '0', '0'
+    rate = max(1024, int(rate / max(1, children)))
+    return str(rate), str(rate // 1024)
+
+
+def create_limiter(config):
+    if config.downloader != 'native' and \
+            (config.limit_rate_hosts or config.limit_rate_schedule):
+        logging.warning('apt-mirror: limit_rate_hosts and limit_rate_schedule '
+                        'need downloader native, they are ignored')
+    return BandwidthLimiter(rate=parse_rate(config.limit_rate),
+                            host_rates=parse_host_rates(config.limit_rate_hosts),
+                            schedule=parse_schedule(config.limit_rate_schedule))
@@ -0,0 +1,85 @@
+#!/usr/bin/env python2
+# coding:utf-8
+
+import logging
+import sys
+import threading
+
+
+class Task(object):
+    """
+    a node of the task graph
+    """
+
+    def __init__(self, name, func, args, deps):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.deps = list(deps)
+        self.done = False
+        self.skipped = False
+        self.error = None
+        return
+
+    def ready(self):
+        return all(dep.done for dep in self.deps)
+
+    def broken(self):
+        return any(dep.error is not None for dep in self.deps)
+
+
+class TaskGraph(object):
+    """
+    run tasks with threads, a task starts as soon as all of its
+    dependencies are done, not when the whole previous stage is done.
+    """
+
+    def __init__(self):
+        self.tasks = []
+        return
+
+    def add(self, name, func, *args, **kwargs):
+        task = Task(name, func, args, kwargs.get('deps', ()))
+        self.tasks.append(task)
+        return task
+
+    def _execute(self, task, cond):
+        try:
+            task.func(*task.args)
+        except Exception:
+            task.error = sys.exc_info()[1]
+            logging.exception('apt-mirror: task "%s" failed' % task.name)
+        with cond:
+            task.done = task.error is None
+            self.running.remove(task)
+            cond.notify()
+
+    def run(self, njobs=1):
+        njobs = max(1, njobs)
+        pending = list(self.tasks)
+        self.running = []
+        cond = threading.Condition()
+        with cond:
+            while pending or self.running:
+                for task in list(pending):
+                    if task.broken():
+                        # never run a task whose dependency failed
+                        task.skipped = True
+                        task.error = Exception(
+                            'apt-mirror: dependency of "%s" failed' % task.name)
+                        pending.remove(task)
+                    elif len(self.running) < njobs and task.ready():
+                        pending.remove(task)
+                        self.running.append(task)
+                        thread = threading.Thread(target=self._execute,
+                                                  args=(task, cond))
+                        thread.daemon = True
+                        thread.start()
+                if self.running:
+                    cond.wait()
+                elif pending and not any(t.ready() or t.broken() for t in pending):
+                    raise Exception('apt-mirror: circular task dependency')
+        errors = [t.error for t in self.tasks
+                  if t.error is not None and not t.skipped]
+        if errors:
+            raise errors[0]
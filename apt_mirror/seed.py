@@ -0,0 +1,208 @@
+#!/usr/bin/env python2
+# coding:utf-8
+"""
+Local sources: file:// mirrors and seed directories.
+
+Before the archive is downloaded, pool files are looked up in the seed
+directories, by store path (an old mirror_path), by path below the
+mirror (a copy of the upstream tree) and by file name (an apt cache like
+/var/cache/apt/archives). A candidate needs the size and the digest from
+the index. It is hard linked into place if allowed and possible,
+otherwise reflinked or copied with copy_file_range.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import stat
+from multiprocessing.pool import ThreadPool
+
+from .utils import sanitise_uri
+from .verify import hash_file
+
+# ioctl(dest, FICLONE, src), linux/fs.h
+FICLONE = 0x40049409
+COPY_CHUNK = 64 << 20
+
+
+def local_path(url):
+    # file:///srv/mirror/debian/dists -> /srv/mirror/debian/dists
+    return '/' + url.split('://', 1)[1].lstrip('/')
+
+
+def copy_data(src_fp, dst_fp, size):
+    if hasattr(os, 'copy_file_range'):
+        offset = 0
+        while offset < size:
+            copied = os.copy_file_range(src_fp.fileno(), dst_fp.fileno(),
+                                        min(COPY_CHUNK, size - offset))
+            if not copied:
+                break
+            offset += copied
+        if offset == size:
+            return
+        src_fp.seek(offset)
+    shutil.copyfileobj(src_fp, dst_fp, 1 << 20)
+
+
+def place_file(source, path, link=True):
+    """
+    put the content of source at path, keeping its mtime; returns how:
+    'link', 'reflink' or 'copy'
+    """
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    tmp_path = path + '.seed'
+    if os.path.lexists(tmp_path):
+        os.unlink(tmp_path)
+    if link:
+        try:
+            os.link(source, tmp_path)
+            os.rename(tmp_path, path)
+            return 'link'
+        except OSError:
+            # another filesystem, or hard links not allowed
+            pass
+    source_stat = os.stat(source)
+    with open(source, 'rb') as src_fp:
+        with open(tmp_path, 'wb') as dst_fp:
+            try:
+                fcntl.ioctl(dst_fp.fileno(), FICLONE, src_fp.fileno())
+                method = 'reflink'
+            except (IOError, OSError):
+                copy_data(src_fp, dst_fp, source_stat.st_size)
+                method = 'copy'
+    os.utime(tmp_path, (source_stat.st_atime, source_stat.st_mtime))
+    os.rename(tmp_path, path)
+    return method
+
+
+def is_fresh(source, path):
+    # wget -N: same size and mtime, no need to copy
+    try:
+        source_stat = os.stat(source)
+        path_stat = os.stat(path)
+    except OSError:
+        return False
+    return source_stat.st_size == path_stat.st_size and \
+        int(source_stat.st_mtime) == int(path_stat.st_mtime)
+
+
+def matches(path, size, checksum):
+    # size 0 is unknown, only the digest is checked then
+    try:
+        path_stat = os.stat(path)
+    except OSError:
+        return False
+    if not stat.S_ISREG(path_stat.st_mode) or \
+            (size and path_stat.st_size != size):
+        return False
+    if checksum is None:
+        return True
+    algorithm, digest = checksum
+    return hash_file((path, algorithm))[1] == digest
+
+
+class Seeds(object):
+    """
+    pool files found in local directories
+    """
+
+    def __init__(self, seed_dirs, link=True, jobs=4):
+        self.seed_dirs = [seed_dir.rstrip('/') for seed_dir in seed_dirs]
+        self.link = link
+        self.jobs = max(1, jobs)
+        return
+
+    def candidates(self, store_path, rel_path):
+        paths = []
+        for seed_dir in self.seed_dirs:
+            for name in (store_path, rel_path, os.path.basename(rel_path)):
+                path = os.path.join(seed_dir, name)
+                if path not in paths:
+                    paths.append(path)
+        return paths
+
+    def find(self, store_path, rel_path, size, checksum):
+        for path in self.candidates(store_path, rel_path):
+            if matches(path, size, checksum):
+                return path
+        return None
+
+    def seed_one(self, task):
+        base_url, rel_path, size, checksum, target_dir = task
+        store_path = sanitise_uri(os.path.join(base_url, rel_path))
+        source = self.find(store_path, rel_path, size, checksum)
+        if source is None:
+            return None
+        try:
+            method = place_file(source, os.path.join(target_dir, store_path),
+                                self.link)
+        except (IOError, OSError) as e:
+            logging.warning('apt-mirror: can\'t seed %s from %s: %s'
+                            % (store_path, source, e))
+            return None
+        return (base_url, rel_path), size, method
+
+    def seed(self, urls, checksums, target_dir):
+        """
+        seed the files of urls, {(base_url, rel_path): size}, that have a
+        checksum; returns {(base_url, rel_path): method} of the seeded ones
+        """
+        # a file name alone is no proof without the digest
+        tasks = [(base_url, rel_path, size,
+                  checksums[(base_url, rel_path)], target_dir)
+                 for (base_url, rel_path), size in sorted(urls.items())
+                 if (base_url, rel_path) in checksums]
+        if not tasks:
+            return {}
+        pool = ThreadPool(self.jobs)
+        try:
+            results = pool.map(self.seed_one, tasks, chunksize=16)
+        finally:
+            pool.close()
+            pool.join()
+        return dict((key, method) for key, _size, method in
+                    [result for result in results if result is not None])
+
+
+def copy_local_files(urls, target_dir, sizes=None, checksums=None,
+                     immutable=False, link=True):
+    """
+    get file:// urls, [(base_url, rel_path)], returns the paths written.
+    Indexes are copied when their size or mtime differ; pool files
+    (immutable) must match the size and digest from the index and may be
+    hard linked.
+    """
+    sizes = sizes or {}
+    checksums = checksums or {}
+    written = []
+    for base_url, rel_path in urls:
+        source = local_path(os.path.join(base_url, rel_path))
+        path = os.path.join(target_dir,
+                            sanitise_uri(os.path.join(base_url, rel_path)))
+        if not os.path.isfile(source):
+            # like a 404
+            continue
+        size = sizes.get((base_url, rel_path), 0)
+        if immutable:
+            if not matches(source, size,
+                           checksums.get((base_url, rel_path))):
+                logging.warning('apt-mirror: %s does not match the index'
+                                % source)
+                continue
+        elif is_fresh(source, path):
+            continue
+        try:
+            place_file(source, path, link and immutable)
+        except (IOError, OSError) as e:
+            logging.warning('apt-mirror: can\'t copy %s: %s' % (source, e))
+            continue
+        written.append(path)
+    return written
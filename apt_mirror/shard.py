@@ -0,0 +1,120 @@
+#!/usr/bin/env python2
+# coding:utf-8
+
+import os
+import time
+import zlib
+
+
+def shard_of(path, shards):
+    # crc32 is stable across hosts and python versions, hash() is not
+    if not isinstance(path, bytes):
+        path = path.encode('utf-8')
+    return (zlib.crc32(path) & 0xffffffff) % shards
+
+
+class ShardPlan(object):
+    """
+    the archive download set of a run, split into shards
+
+    Files in shard_path, which must be shared by the coordinator and every
+    worker:
+        plan            id of the current run, written last
+        shard-N.ID.list base_url, rel_path and size of the files of shard N
+                        in run ID
+        shard-N.done    written by the worker of shard N when it is done:
+                        run id, then the files it could not download
+    """
+
+    def __init__(self, shard_path, shards):
+        self.shard_path = shard_path
+        self.shards = shards
+        return
+
+    def path(self, name):
+        return os.path.join(self.shard_path, name)
+
+    def _write(self, name, lines):
+        tmp_file = self.path(name + '.tmp')
+        with open(tmp_file, 'w') as fp:
+            for line in lines:
+                fp.write(line + '\n')
+        os.rename(tmp_file, self.path(name))
+
+    def run_id(self):
+        with open(self.path('plan')) as fp:
+            return fp.read().strip()
+
+    def write(self, urls):
+        if not os.path.isdir(self.shard_path):
+            os.makedirs(self.shard_path)
+        run_id = '%d.%d' % (time.time(), os.getpid())
+        parts = [[] for _i in range(self.shards)]
+        for (base_url, rel_path), size in sorted(urls.items()):
+            shard = shard_of(rel_path, self.shards)
+            parts[shard].append('%s\t%s\t%d' % (base_url, rel_path, size))
+        # a worker which sees the new plan finds its list complete, one
+        # which still sees the old plan reads and reports the old run
+        for shard in range(self.shards):
+            self._write('shard-%d.%s.list' % (shard, run_id), parts[shard])
+        self._write('plan', [run_id])
+        for name in os.listdir(self.shard_path):
+            if name.startswith('shard-') and name.endswith('.list') and \
+                    not name.endswith('.%s.list' % run_id):
+                try:
+                    os.unlink(self.path(name))
+                except OSError:
+                    pass
+        return run_id
+
+    def read(self, shard, run_id):
+        urls = {}
+        with open(self.path('shard-%d.%s.list' % (shard, run_id))) as fp:
+            for line in fp:
+                base_url, rel_path, size = line.rstrip('\n').split('\t')
+                urls[(base_url, rel_path)] = int(size)
+        return urls
+
+    def report(self, shard, run_id, failed):
+        self._write('shard-%d.done' % shard, [run_id] + sorted(failed))
+
+    def result(self, shard, run_id):
+        """
+        files a shard failed to download, None if it is not done yet
+        """
+        try:
+            fp = open(self.path('shard-%d.done' % shard))
+        except IOError:
+            return None
+        lines = fp.read().splitlines()
+        fp.close()
+        if not lines or lines[0] != run_id:
+            # left over from an earlier run
+            return None
+        return lines[1:]
+
+    def wait(self, run_id, timeout=0, workers=()):
+        """
+        wait until every shard has reported, return the failed files
+        """
+        started = time.time()
+        results = {}
+        while len(results) < self.shards:
+            for shard in range(self.shards):
+                if shard not in results:
+                    failed = self.result(shard, run_id)
+                    if failed is not None:
+                        results[shard] = failed
+            for worker in workers:
+                if worker.exitcode and worker.shard not in results:
+                    raise Exception('apt-mirror: worker of shard %d exited '
+                                    'with %d' % (worker.shard, worker.exitcode))
+            if len(results) < self.shards:
+                if timeout and time.time() - started > timeout:
+                    raise Exception('apt-mirror: timeout waiting for shards %s'
+                                    % sorted(set(range(self.shards)) - set(results)))
+                time.sleep(2)
+        failed = []
+        for shard in sorted(results):
+            failed.extend(results[shard])
+        return failed
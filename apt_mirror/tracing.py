@@ -0,0 +1,121 @@
+#!/usr/bin/env python2
+# coding:utf-8
+"""
+Timeline of a run in Chrome Trace Event format (apt-mirror --trace FILE).
+
+The file opens in chrome://tracing or https://ui.perfetto.dev. It has
+spans for the phases of a run, every download stage, every index that
+is processed and every transfer, one track per thread, and counters of
+the transfers in flight per host. wget and rsync are traced per child
+process, the native downloader per file.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Tracer(object):
+    """
+    collect trace events in memory, write them at the end of the run
+    """
+
+    def __init__(self, trace_file):
+        self.trace_file = trace_file
+        self.started = time.time()
+        self.pid = os.getpid()
+        self.events = [{'name': 'process_name', 'ph': 'M', 'pid': self.pid,
+                        'tid': 0, 'args': {'name': 'apt-mirror'}}]
+        self.threads = {}
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        return
+
+    def timestamp(self, when):
+        # microseconds since the start of the run
+        return int((when - self.started) * 1000000)
+
+    def tid(self, track=None):
+        # small numbers for the tracks, named after the threads; spans of
+        # one track must nest, so child processes get tracks of their own
+        key = track or threading.current_thread().ident
+        if key not in self.threads:
+            self.threads[key] = len(self.threads) + 1
+            self.events.append({'name': 'thread_name', 'ph': 'M',
+                                'pid': self.pid, 'tid': self.threads[key],
+                                'args': {'name': track or
+                                         threading.current_thread().name}})
+        return self.threads[key]
+
+    def complete(self, name, category, start, end=None, args=None,
+                 track=None):
+        """
+        a span from start to end (time.time() values) on this thread, or
+        on the named track
+        """
+        if end is None:
+            end = time.time()
+        with self.lock:
+            event = {'name': name, 'cat': category, 'ph': 'X',
+                     'pid': self.pid, 'tid': self.tid(track),
+                     'ts': self.timestamp(start),
+                     'dur': max(0, self.timestamp(end) -
+                                self.timestamp(start))}
+            if args:
+                event['args'] = args
+            self.events.append(event)
+
+    def instant(self, name, category, args=None):
+        with self.lock:
+            event = {'name': name, 'cat': category, 'ph': 'i', 's': 't',
+                     'pid': self.pid, 'tid': self.tid(),
+                     'ts': self.timestamp(time.time())}
+            if args:
+                event['args'] = args
+            self.events.append(event)
+
+    def transfer(self, host, delta):
+        # one more (or one less) transfer from host in flight
+        with self.lock:
+            self.in_flight[host] = self.in_flight.get(host, 0) + delta
+            self.events.append({'name': 'transfers in flight', 'ph': 'C',
+                                'pid': self.pid,
+                                'ts': self.timestamp(time.time()),
+                                'args': dict(self.in_flight)})
+
+    @contextmanager
+    def span(self, name, category, args=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.complete(name, category, start, args=args)
+
+    def write(self):
+        directory = os.path.dirname(os.path.abspath(self.trace_file))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self.lock:
+            events = list(self.events)
+        tmp_file = self.trace_file + '.tmp'
+        with open(tmp_file, 'w') as fp:
+            json.dump({'traceEvents': events,
+                       'displayTimeUnit': 'ms',
+                       'otherData': {'started': time.strftime(
+                           '%Y-%m-%d %H:%M:%S',
+                           time.localtime(self.started))}}, fp)
+        os.rename(tmp_file, self.trace_file)
+
+
+@contextmanager
+def trace_span(tracer, name, category, args=None):
+    """
+    tracer.span(), or nothing without a tracer
+    """
+    if tracer is None:
+        yield
+        return
+    with tracer.span(name, category, args):
+        yield
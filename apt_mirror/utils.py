@@ -8,7 +8,8 @@ import logging
 TILDE = False
 
 def sanitise_uri(uri):
-    uri = uri.split('://')[-1]
+    # file:///srv/mirror is stored as srv/mirror
+    uri = uri.split('://')[-1].lstrip('/')
     if uri.find('@') >= 0:
         uri = uri.split('@')[-1]
     # and port information
@@ -17,6 +18,9 @@ def sanitise_uri(uri):
         uri = uri.replace('~', '%7E')
     return uri
 
+def url_host(url):
+    return url.split('://')[-1].split('/')[0]
+
 def quoted_path(path):
     path = path.replace("'", "\\'")
     return "'" + path + "'"
@@ -25,6 +29,20 @@ def round_number(n):
     return round(n, 1)
 
 
+def parse_size(value):
+    """
+    bytes from a size like "256m", with k, m and g for KiB, MiB and GiB
+    """
+    value = str(value).strip().lower()
+    if not value:
+        return 0
+    power = 0
+    if value[-1] in 'kmg':
+        power = ' kmg'.index(value[-1])
+        value = value[:-1]
+    return int(float(value) * 1024 ** power)
+
+
 def format_bytes(bytes):
     size_name = 'bytes'
     KiB = 1024
@@ -0,0 +1,126 @@
+#!/usr/bin/env python2
+# coding:utf-8
+
+import hashlib
+import multiprocessing
+import os
+
+# checksum lists written by process_index, strongest first
+CHECKSUM_LISTS = [('SHA256', 'sha256'), ('SHA1', 'sha1'), ('MD5', 'md5')]
+BLOCK_SIZE = 4 << 20
+
+
+def read_checksums(var_path, prefix=''):
+    """
+    {store_path: (algorithm, digest)} for the files under prefix
+    """
+    checksums = {}
+    for list_name, algorithm in CHECKSUM_LISTS:
+        try:
+            list_file = open(os.path.join(var_path, list_name))
+        except IOError:
+            continue
+        for line in list_file:
+            parts = line.rstrip('\n').split('  ', 1)
+            if len(parts) != 2:
+                continue
+            digest, store_path = parts
+            if store_path.startswith(prefix) and store_path not in checksums:
+                checksums[store_path] = (algorithm, digest)
+        list_file.close()
+    return checksums
+
+
+def hash_file(task):
+    path, algorithm = task
+    try:
+        fp = open(path, 'rb')
+    except IOError:
+        return path, None
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fp.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    digest = hashlib.new(algorithm)
+    for block in iter(lambda: fp.read(BLOCK_SIZE), b''):
+        digest.update(block)
+    fp.close()
+    return path, digest.hexdigest()
+
+
+class VerifyState(object):
+    """
+    size, mtime and digest of the files that passed the last check
+    """
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.files = {}
+        try:
+            fp = open(state_file)
+        except IOError:
+            return
+        for line in fp:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) == 4:
+                store_path, size, mtime, digest = parts
+                self.files[store_path] = (int(size), mtime, digest)
+        fp.close()
+        return
+
+    def unchanged(self, store_path, stat, digest):
+        return self.files.get(store_path) == \
+            (stat.st_size, repr(stat.st_mtime), digest)
+
+    def update(self, store_path, stat, digest):
+        self.files[store_path] = (stat.st_size, repr(stat.st_mtime), digest)
+
+    def discard(self, store_path):
+        self.files.pop(store_path, None)
+
+    def prune(self, prefix, checksums):
+        # forget files that are no longer in the indexes
+        for store_path in list(self.files):
+            if store_path.startswith(prefix) and store_path not in checksums:
+                del self.files[store_path]
+
+    def save(self):
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as fp:
+            for store_path in sorted(self.files):
+                size, mtime, digest = self.files[store_path]
+                fp.write('%s\t%d\t%s\t%s\n' % (store_path, size, mtime, digest))
+        os.rename(tmp_file, self.state_file)
+
+
+def verify_files(mirror_path, checksums, state, processes=0):
+    """
+    hash the files whose size or mtime changed since the last check,
+    return the store paths that are missing or do not match
+    """
+    failed = []
+    tasks = []
+    for store_path in sorted(checksums):
+        algorithm, digest = checksums[store_path]
+        path = os.path.join(mirror_path, store_path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            state.discard(store_path)
+            failed.append(store_path)
+            continue
+        if not state.unchanged(store_path, stat, digest):
+            tasks.append((path, algorithm))
+
+    if tasks:
+        pool = multiprocessing.Pool(processes or None)
+        try:
+            for path, digest in pool.imap_unordered(hash_file, tasks, 16):
+                store_path = os.path.relpath(path, mirror_path)
+                if digest == checksums[store_path][1]:
+                    state.update(store_path, os.stat(path), digest)
+                else:
+                    state.discard(store_path)
+                    failed.append(store_path)
+        finally:
+            pool.close()
+            pool.join()
+    return sorted(failed)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python2
+# coding:utf-8
+"""
+Debian version ordering and the keep_versions retention policy.
+
+compare_versions follows dpkg: epoch, then upstream version, then Debian
+revision, each compared as alternating non-digit and digit parts where
+"~" sorts before everything, even the end of the part.
+"""
+
+import functools
+
+
+def _order(char):
+    if char == '~':
+        return -1
+    if char.isdigit():
+        return 0
+    if char.isalpha():
+        return ord(char)
+    return ord(char) + 256
+
+
+def _compare_part(a, b):
+    # dpkg's verrevcmp
+    i = j = 0
+    while i < len(a) or j < len(b):
+        while (i < len(a) and not a[i].isdigit()) or \
+                (j < len(b) and not b[j].isdigit()):
+            ac = _order(a[i]) if i < len(a) else 0
+            bc = _order(b[j]) if j < len(b) else 0
+            if ac != bc:
+                return ac - bc
+            i += 1
+            j += 1
+        while i < len(a) and a[i] == '0':
+            i += 1
+        while j < len(b) and b[j] == '0':
+            j += 1
+        first_diff = 0
+        while i < len(a) and a[i].isdigit() and \
+                j < len(b) and b[j].isdigit():
+            if not first_diff:
+                first_diff = ord(a[i]) - ord(b[j])
+            i += 1
+            j += 1
+        if i < len(a) and a[i].isdigit():
+            return 1
+        if j < len(b) and b[j].isdigit():
+            return -1
+        if first_diff:
+            return first_diff
+    return 0
+
+
+def parse_version(version):
+    """
+    (epoch, upstream, revision) of a Debian version string
+    """
+    version = version.strip()
+    epoch = 0
+    if ':' in version:
+        epoch, version = version.split(':', 1)
+        try:
+            epoch = int(epoch)
+        except ValueError:
+            epoch = 0
+    revision = ''
+    if '-' in version:
+        version, revision = version.rsplit('-', 1)
+    return epoch, version, revision
+
+
+def compare_versions(a, b):
+    """
+    negative, zero or positive like cmp()
+    """
+    a_epoch, a_upstream, a_revision = parse_version(a)
+    b_epoch, b_upstream, b_revision = parse_version(b)
+    if a_epoch != b_epoch:
+        return a_epoch - b_epoch
+    return _compare_part(a_upstream, b_upstream) or \
+        _compare_part(a_revision, b_revision)
+
+
+version_key = functools.cmp_to_key(compare_versions)
+
+
+def newest_versions(entries, count, source=False):
+    """
+    the entries of an index whose version is one of the count newest of
+    their package and architecture; source packages have no architecture
+    of their own. Entries without Package or Version are kept.
+    """
+    entries = list(entries)
+    versions = {}
+    for entry in entries:
+        if 'Package' not in entry or 'Version' not in entry:
+            continue
+        key = entry['Package'], '' if source else entry.get('Architecture')
+        versions.setdefault(key, set()).add(entry['Version'])
+    kept = {}
+    for key, package_versions in versions.items():
+        if len(package_versions) > count:
+            package_versions = set(sorted(package_versions, key=version_key,
+                                          reverse=True)[:count])
+        kept[key] = package_versions
+    for entry in entries:
+        if 'Package' not in entry or 'Version' not in entry:
+            yield entry
+            continue
+        key = entry['Package'], '' if source else entry.get('Architecture')
+        if entry['Version'] in kept[key]:
+            yield entry
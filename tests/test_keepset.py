@@ -0,0 +1,81 @@
+#!/usr/bin/env python2
+# coding:utf-8
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from apt_mirror.keepset import KeepSet, sort_key
+
+
+class KeepSetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        return
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_merge_of_runs(self):
+        paths = ['a/b', 'a-b/x', 'a/b\nc', 'a/b/c', 'z', 'a b',
+                 'a/b', 'z', 'a\tb/c', 'a/b\nc']
+        keep = KeepSet(self.tmp_dir, run_size=3)
+        for path in paths:
+            keep[path] = 1
+        # several runs on disk and some keys still in memory
+        self.assertTrue(len(keep.runs) > 1)
+        self.assertEqual(list(keep.keys()),
+                         sorted(set(sort_key(path) for path in paths)))
+        keep.close()
+
+    def test_walk_order(self):
+        # "a/b" is visited before "a-b", a depth first walk sorted by name
+        # sees the entries of a before its sibling a-b
+        self.assertTrue(sort_key('a/b') < sort_key('a-b'))
+        self.assertTrue(sort_key('a/b/c') < sort_key('a/b-c'))
+
+    def test_cursor(self):
+        keep = KeepSet(self.tmp_dir, run_size=2)
+        for path in ['pool/a', 'pool/c', 'pool/b\nx', 'pool/e']:
+            keep[path] = 1
+        cursor = keep.cursor()
+        self.assertFalse(cursor.seek(sort_key('pool')))
+        self.assertTrue(cursor.seek(sort_key('pool/a')))
+        self.assertTrue(cursor.seek(sort_key('pool/b\nx')))
+        self.assertFalse(cursor.seek(sort_key('pool/d')))
+        self.assertTrue(cursor.seek(sort_key('pool/e')))
+        self.assertFalse(cursor.seek(sort_key('pool/f')))
+        keep.close()
+
+    def test_close_removes_runs(self):
+        keep = KeepSet(self.tmp_dir, run_size=1)
+        keep['a'] = 1
+        keep['b'] = 1
+        self.assertEqual(len(os.listdir(self.tmp_dir)), 1)
+        keep.close()
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+    def test_stale_runs_are_removed(self):
+        keep = KeepSet(self.tmp_dir, run_size=1)
+        keep['a'] = 1
+        stale = os.path.join(self.tmp_dir, 'keep.stale')
+        os.mkdir(stale)
+        open(os.path.join(stale, 'lock'), 'w').close()
+        # locks are per process: another one sees the run dir in use
+        subprocess.check_call(
+            [sys.executable, '-c',
+             'import sys; sys.path.insert(0, sys.argv[1]); '
+             'from apt_mirror.keepset import KeepSet; KeepSet(sys.argv[2])',
+             os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+             self.tmp_dir])
+        self.assertEqual(os.listdir(self.tmp_dir),
+                         [os.path.basename(keep.run_dir)])
+        keep.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
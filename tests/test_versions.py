@@ -0,0 +1,76 @@
+#!/usr/bin/env python2
+# coding:utf-8
+
+import unittest
+
+from apt_mirror.versions import compare_versions, newest_versions
+
+
+def sign(number):
+    return (number > 0) - (number < 0)
+
+
+# (a, b, sign of compare_versions(a, b)), as dpkg --compare-versions
+CASES = [
+    ('1.0', '1.0', 0),
+    ('1.0', '1.1', -1),
+    ('2.0', '10.0', -1),
+    ('1.001', '1.1', 0),
+    # epoch
+    ('1:0.1', '2.0', 1),
+    ('0:1.0', '1.0', 0),
+    ('1:1.0', '2:0.1', -1),
+    # tilde sorts before everything, even the end of the part
+    ('1.0~rc1', '1.0', -1),
+    ('1.0~', '1.0', -1),
+    ('1.0~~', '1.0~', -1),
+    ('1.0~rc1', '1.0~rc2', -1),
+    # revision
+    ('1.0-1', '1.0-2', -1),
+    ('1.0-10', '1.0-9', 1),
+    ('1.0', '1.0-0', 0),
+    ('1.0-1~bpo1', '1.0-1', -1),
+    ('1.0-a-1', '1.0-a-2', -1),
+    # letters sort before other characters, the end before letters
+    ('1.0a', '1.0+', -1),
+    ('1.0a', '1.0.', -1),
+    ('1.0+', '1.0.', -1),
+    ('1.0', '1.0a', -1),
+    ('1.0a', '1.0b', -1),
+]
+
+
+class CompareVersionsTest(unittest.TestCase):
+
+    def test_cases(self):
+        for a, b, expected in CASES:
+            self.assertEqual(sign(compare_versions(a, b)), expected,
+                             '%s vs %s' % (a, b))
+            self.assertEqual(sign(compare_versions(b, a)), -expected,
+                             '%s vs %s' % (b, a))
+
+
+class NewestVersionsTest(unittest.TestCase):
+
+    def test_per_package_and_architecture(self):
+        entries = [
+            {'Package': 'app', 'Version': '1.0', 'Architecture': 'amd64'},
+            {'Package': 'app', 'Version': '1.0~rc1', 'Architecture': 'amd64'},
+            {'Package': 'app', 'Version': '1:0.1', 'Architecture': 'amd64'},
+            {'Package': 'app', 'Version': '0.9', 'Architecture': 'i386'},
+            {'Filename': 'no/package'},
+        ]
+        kept = list(newest_versions(entries, 1))
+        self.assertEqual(kept, [entries[2], entries[3], entries[4]])
+
+    def test_sources_ignore_architecture(self):
+        entries = [
+            {'Package': 'base', 'Version': '1.0', 'Architecture': 'any'},
+            {'Package': 'base', 'Version': '1.1', 'Architecture': 'all'},
+        ]
+        kept = list(newest_versions(entries, 1, source=True))
+        self.assertEqual(kept, [entries[1]])
+
+
+if __name__ == '__main__':
+    unittest.main()